@@ -0,0 +1,182 @@
+'''Сжатие резервных копий БД потоком с контрольной суммой. Файл сжимается частями параллельно в потоках
+(gzip - набор членов gzip, xz - набор потоков xz, zlib и lzma освобождают GIL), поэтому копия читается стандартными
+средствами (gzip, xz, архиваторы). SHA-256 исходных данных записывается рядом в файл .sha256 в формате sha256sum
+(после распаковки копию можно проверить командой sha256sum -c). Проверка копии распаковывает ее потоком без
+временных файлов.
+
+Проверка и восстановление из командной строки:
+    python backup_compress.py verify <файл или папка> [...]
+    python backup_compress.py restore <сжатая копия> <файл БД>'''
+
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+from hashlib import sha256
+import lzma
+from pathlib import Path
+import zlib
+
+
+# Методы сжатия: расширение файла
+SUFFIXES = {'gzip': '.gz', 'xz': '.xz'}
+# Расширение файла контрольной суммы (добавляется к имени копии)
+CHECKSUM_SUFFIX = '.sha256'
+
+
+def _compress_chunk(chunk, method, level):
+    '''Сжатие части файла в отдельный член gzip или поток xz'''
+    if method == 'gzip': return gzip.compress(chunk, compresslevel=level)
+    return lzma.compress(chunk, preset=level)
+
+
+def compress_file(
+    source, target, method='gzip', workers=4, level=6, chunk_size=4 * 2 ** 20
+):
+    '''Сжимает файл source в target через временный файл .part и
+    записывает файл контрольной суммы. Возвращает SHA-256 исходных данных'''
+    if method not in SUFFIXES:
+        raise ValueError(f'Неизвестный метод сжатия: {method}')
+    target = Path(target)
+    part_file = target.with_name(target.name + '.part')
+    file_hash = sha256()
+    try:
+        with open(source, 'rb') as src, open(part_file, 'wb') as dst, (
+            ThreadPoolExecutor(max_workers=workers)
+        ) as executor:
+            # Не более 2 частей на поток в памяти, запись в порядке частей
+            pending = deque()
+            for chunk in iter(lambda: src.read(chunk_size), b''):
+                file_hash.update(chunk)
+                pending.append(
+                    executor.submit(_compress_chunk, chunk, method, level)
+                )
+                if len(pending) >= workers * 2:
+                    dst.write(pending.popleft().result())
+            while pending:
+                dst.write(pending.popleft().result())
+        # Контрольная сумма записывается раньше копии: копия без файла
+        # контрольной суммы не появляется
+        _write_checksum(target, file_hash.hexdigest())
+        part_file.replace(target)
+    except Exception:
+        part_file.unlink(missing_ok=True)
+        raise
+    return file_hash.hexdigest()
+
+
+def checksum_path(path):
+    '''Путь файла контрольной суммы копии'''
+    path = Path(path)
+    return path.with_name(path.name + CHECKSUM_SUFFIX)
+
+
+def _write_checksum(target, digest):
+    '''Файл контрольной суммы в формате sha256sum для распакованной копии'''
+    path = checksum_path(target)
+    part_file = path.with_name(path.name + '.part')
+    part_file.write_text(f'{digest}  {target.stem}\n', encoding='utf-8')
+    part_file.replace(path)
+
+
+def _read_checksum(path):
+    '''Метод сжатия, размер сжатых данных и SHA-256 исходных данных'''
+    path = Path(path)
+    try:
+        line = checksum_path(path).read_text(encoding='utf-8')
+    except FileNotFoundError:
+        raise ValueError(
+            f'Нет файла контрольной суммы копии: {checksum_path(path).name}'
+        ) from None
+    methods = {suffix: method for method, suffix in SUFFIXES.items()}
+    if path.suffix not in methods:
+        raise ValueError(f'Неизвестное расширение копии: {path.suffix}')
+    return (
+        methods[path.suffix], path.stat().st_size,
+        bytes.fromhex(line.split()[0]),
+    )
+
+
+def _new_decompressor(method):
+    if method == 'gzip': return zlib.decompressobj(wbits=31)
+    return lzma.LZMADecompressor()
+
+
+def iter_decompressed(path, block_size=2 ** 20):
+    '''Распакованные данные сжатой копии частями. В конце проверяется
+    SHA-256 из файла контрольной суммы, при несовпадении - ValueError'''
+    method, remaining, digest = _read_checksum(path)
+    with open(path, 'rb') as file:
+        file_hash = sha256()
+        decompressor = _new_decompressor(method)
+        while remaining:
+            data = file.read(min(block_size, remaining))
+            if not data: raise ValueError('Файл копии обрезан')
+            remaining -= len(data)
+            # Части файла - отдельные члены gzip (потоки xz)
+            while data:
+                chunk = decompressor.decompress(data)
+                file_hash.update(chunk)
+                yield chunk
+                if not decompressor.eof: break
+                data = decompressor.unused_data
+                decompressor = _new_decompressor(method)
+        if file_hash.digest() != digest:
+            raise ValueError('Контрольная сумма копии не совпадает')
+
+
+def verify_file(path):
+    '''Проверяет сжатую копию потоковой распаковкой.
+    Возвращает (успех, сообщение)'''
+    try:
+        size = sum(len(chunk) for chunk in iter_decompressed(path))
+    except Exception as err:
+        return False, f'{path}: ошибка - {err}'
+    return True, f'{path}: в порядке, {size} байт'
+
+
+def decompress_file(path, target):
+    '''Восстанавливает файл БД из сжатой копии через временный файл'''
+    target = Path(target)
+    part_file = target.with_name(target.name + '.part')
+    try:
+        with open(part_file, 'wb') as file:
+            for chunk in iter_decompressed(path): file.write(chunk)
+    except Exception:
+        part_file.unlink(missing_ok=True)
+        raise
+    part_file.replace(target)
+
+
+def main(argv=None):
+    '''Командная строка: проверка и восстановление сжатых копий'''
+    parser = argparse.ArgumentParser(
+        description='Сжатые резервные копии БД с контрольной суммой'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    verify_parser = commands.add_parser('verify', help='проверить копии')
+    verify_parser.add_argument('paths', nargs='+')
+    restore_parser = commands.add_parser('restore', help='восстановить копию')
+    restore_parser.add_argument('path')
+    restore_parser.add_argument('target')
+    args = parser.parse_args(argv)
+
+    if args.command == 'restore':
+        decompress_file(args.path, args.target)
+        print(f'Копия {args.path} восстановлена в {args.target}')
+        return 0
+    failed = 0
+    for path in map(Path, args.paths):
+        files = sorted(
+            item for item in path.iterdir()
+            if item.suffix in SUFFIXES.values()
+        ) if path.is_dir() else [path]
+        for file in files:
+            ok, msg = verify_file(file)
+            failed += not ok
+            print(msg)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
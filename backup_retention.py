@@ -0,0 +1,132 @@
+'''Хранение резервных копий по схеме "дед-отец-сын" (GFS). Папка с копиями просматривается один раз, даты копий
+разбираются из имен один раз, затем строится план: хранить все копии за последние дни, последнюю копию каждой из
+последних недель и месяцев и не менее заданного количества самых новых копий. Остальные копии удаляются одним
+проходом по плану, без повторного просмотра папки; в режиме dry_run план только выводится в отчет.'''
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import os
+import re
+
+
+# daily - дней, за которые хранятся все копии; weekly, monthly - количество
+# последних недель и месяцев, для которых хранится последняя копия;
+# min_keep - самых новых копий, которые хранятся всегда
+RetentionPolicy = namedtuple(
+    'RetentionPolicy', 'daily weekly monthly min_keep', defaults=(7, 4, 3, 3)
+)
+# Копия: дата, имя, путь (None для копий без файла, например манифестов)
+BackupEntry = namedtuple('BackupEntry', 'date name path')
+# План: хранимые копии с причинами и удаляемые копии
+RetentionPlan = namedtuple('RetentionPlan', 'keep delete')
+
+
+class RetentionEngine:
+    '''Построение и применение плана хранения копий'''
+    def __init__(
+        self, prefix, date_format, policy=RetentionPolicy(), companions=(),
+    ):
+        self.pattern = re.compile(re.escape(prefix) + r'(\d{2}_\d{2}_\d{2})')
+        self.date_format = date_format
+        self.policy = policy
+        # Окончания имен файлов-спутников копий (например, контрольных
+        # сумм): такие файлы не считаются отдельными копиями
+        self.companions = tuple(companions)
+
+
+    def parse(self, name):
+        '''Дата копии из имени или None'''
+        match = self.pattern.search(name)
+        if not match: return None
+        try:
+            return datetime.strptime(match.group(1), self.date_format).date()
+        except ValueError:
+            return None
+
+
+    def scan(self, backup_dir):
+        '''Копии папки за один просмотр'''
+        entries = []
+        with os.scandir(backup_dir) as items:
+            for item in items:
+                if self.companions and item.name.endswith(self.companions):
+                    continue
+                created = self.parse(item.name)
+                if created is not None:
+                    entries.append(BackupEntry(created, item.name, item.path))
+        return entries
+
+
+    def entries_from_names(self, names):
+        '''Копии по списку имен (например, манифестов хранилища блоков)'''
+        entries = []
+        for name in names:
+            created = self.parse(name)
+            if created is not None:
+                entries.append(BackupEntry(created, name, None))
+        return entries
+
+
+    def plan(self, entries, today):
+        '''План хранения. Недели и месяцы считаются по копиям: последняя
+        копия каждой из weekly последних недель, в которые были копии'''
+        if isinstance(today, datetime): today = today.date()
+        policy = self.policy
+        # Незавершенные копии прошлых дней удаляются, сегодняшние
+        # могут еще записываться
+        partial = [entry for entry in entries if entry.name.endswith('.part')]
+        entries = sorted(
+            (entry for entry in entries if not entry.name.endswith('.part')),
+            key=lambda entry: (entry.date, entry.name), reverse=True
+        )
+        reasons = {}
+        for entry in entries[:policy.min_keep]:
+            reasons.setdefault(entry.name, []).append('последние')
+        start = today - timedelta(policy.daily)
+        for entry in entries:
+            if entry.date >= start:
+                reasons.setdefault(entry.name, []).append('день')
+        for title, count, bucket in (
+            ('неделя', policy.weekly, lambda day: day.isocalendar()[:2]),
+            ('месяц', policy.monthly, lambda day: (day.year, day.month)),
+        ):
+            seen = set()
+            for entry in entries:
+                if len(seen) >= count: break
+                key = bucket(entry.date)
+                if key in seen: continue
+                seen.add(key)
+                reasons.setdefault(entry.name, []).append(title)
+        keep = [
+            (entry, reasons[entry.name]) for entry in entries
+            if entry.name in reasons
+        ]
+        delete = [entry for entry in entries if entry.name not in reasons]
+        delete += [entry for entry in partial if entry.date < today]
+        return RetentionPlan(keep, delete)
+
+
+    @staticmethod
+    def report(plan):
+        '''Текстовый отчет по плану'''
+        lines = [
+            f'Хранить: {entry.name} ({", ".join(reasons)})'
+            for entry, reasons in plan.keep
+        ]
+        lines += [f'Удалить: {entry.name}' for entry in plan.delete]
+        return '\n'.join(lines) or 'Копии не найдены'
+
+
+    @staticmethod
+    def apply(plan, delete=None):
+        '''Удаляет копии плана. delete - функция удаления копии (по
+        умолчанию удаление файла). Возвращает удаленные копии и ошибки'''
+        deleted, errors = [], []
+        for entry in plan.delete:
+            try:
+                if delete is None: os.remove(entry.path)
+                else: delete(entry)
+                deleted.append(entry)
+            except OSError as err:
+                errors.append((entry, err))
+        return deleted, errors
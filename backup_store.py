@@ -0,0 +1,281 @@
+'''Хранилище резервных копий БД с дедупликацией по блокам. Файл БД делится на блоки фиксированного размера
+(кратного размеру страницы SQLite), каждый уникальный блок хранится один раз под именем своего хэша SHA-256,
+а на каждую копию записывается небольшой манифест со списком блоков. Неизмененные страницы не копируются
+повторно, поэтому объем записи в папку на сервере зависит от объема изменений, а не от размера БД.
+Хранилище общее для всех рабочих мест: на время записи копии создается отметка в папке pending, сборка мусора
+не запускается (и прерывается) при незавершенной записи и не удаляет недавно записанные блоки. Имеющиеся блоки
+при записи копии не проверяются по одному: блоки последней копии считаются имеющимися, а если во время записи
+работала сборка мусора (ее отметка в файле gc изменилась), все блоки копии проверяются перед записью манифеста.
+
+Восстановление из командной строки:
+    python backup_store.py list <папка хранилища>
+    python backup_store.py restore <папка хранилища> <имя копии> <файл БД>'''
+
+import argparse
+from hashlib import sha256
+import json
+import os
+from pathlib import Path
+import time
+import uuid
+
+
+class BlockStore:
+    '''Хранилище блоков и манифестов резервных копий'''
+    def __init__(
+        self, root, block_size=64 * 1024, min_block_age=3600,
+        pending_timeout=24 * 3600,
+    ):
+        self.root = Path(root)
+        self.block_size = block_size
+        self.blocks_dir = self.root / 'blocks'
+        self.manifests_dir = self.root / 'manifests'
+        # Отметки незавершенной записи копий
+        self.pending_dir = self.root / 'pending'
+        # Отметка сборки мусора: новое значение при каждом запуске
+        self.gc_file = self.root / 'gc'
+        # Блоки моложе min_block_age секунд сборка мусора не удаляет
+        self.min_block_age = min_block_age
+        # Отметка старше pending_timeout секунд считается оставшейся
+        # от прерванной записи
+        self.pending_timeout = pending_timeout
+
+
+    def _block_path(self, digest):
+        '''Путь блока: подпапка по первым двум символам хэша'''
+        return self.blocks_dir / digest[:2] / digest
+
+
+    def _manifest_path(self, name):
+        return self.manifests_dir / f'{name}.json'
+
+
+    def manifests(self):
+        '''Имена сохраненных копий'''
+        if not self.manifests_dir.is_dir(): return []
+        return sorted(path.stem for path in self.manifests_dir.glob('*.json'))
+
+
+    def read_manifest(self, name):
+        with open(self._manifest_path(name), encoding='utf-8') as file:
+            return json.load(file)
+
+
+    def _referenced_blocks(self):
+        '''Хэши блоков, на которые ссылаются манифесты'''
+        blocks = set()
+        for name in self.manifests():
+            blocks.update(self.read_manifest(name)['blocks'])
+        return blocks
+
+
+    def save(self, source_file, name):
+        '''Сохраняет файл как копию name. Записываются только блоки,
+        которых еще нет в хранилище. Возвращает (количество новых блоков,
+        записано байт)'''
+        self.manifests_dir.mkdir(parents=True, exist_ok=True)
+        self.pending_dir.mkdir(parents=True, exist_ok=True)
+        pending = self.pending_dir / f'{name}.{uuid.uuid4().hex}'
+        pending.touch()
+        try:
+            return self._save(source_file, name)
+        finally:
+            pending.unlink(missing_ok=True)
+
+
+    def _save(self, source_file, name):
+        '''Запись блоков и манифеста копии'''
+        # Отметка сборки мусора на начало записи
+        gc_mark = self._gc_mark()
+        # Блоки последней копии есть в хранилище: сборка мусора не удаляет
+        # блоки манифестов. Остальные блоки проверяются по одному, поэтому
+        # обращений к папке столько, сколько изменилось блоков
+        known = self._latest_blocks()
+        file_hash = sha256()
+        blocks = []
+        size = new_blocks = written = 0
+        with open(source_file, 'rb') as file:
+            for block in iter(lambda: file.read(self.block_size), b''):
+                file_hash.update(block)
+                size += len(block)
+                digest = sha256(block).hexdigest()
+                blocks.append(digest)
+                if digest in known: continue
+                known.add(digest)
+                path = self._block_path(digest)
+                if path.is_file(): continue
+                path.parent.mkdir(parents=True, exist_ok=True)
+                _write_atomic(path, block)
+                new_blocks += 1
+                written += len(block)
+        # Сборка мусора, начатая до отметки о записи, могла удалить
+        # использованные блоки: тогда все блоки копии проверяются, а
+        # удаленные записываются заново
+        if self._gc_mark(wait=True) != gc_mark:
+            missing = {
+                digest for digest in set(blocks)
+                if not self._block_path(digest).is_file()
+            }
+            if missing:
+                with open(source_file, 'rb') as file:
+                    for block in iter(
+                        lambda: file.read(self.block_size), b''
+                    ):
+                        digest = sha256(block).hexdigest()
+                        if digest not in missing: continue
+                        missing.discard(digest)
+                        path = self._block_path(digest)
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        _write_atomic(path, block)
+                        new_blocks += 1
+                        written += len(block)
+        manifest = {
+            'name': name,
+            'size': size,
+            'block_size': self.block_size,
+            'sha256': file_hash.hexdigest(),
+            'blocks': blocks,
+        }
+        # Манифест записывается последним: копия без манифеста не видна
+        _write_atomic(
+            self._manifest_path(name),
+            json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+        )
+        return new_blocks, written
+
+
+    def _latest_blocks(self):
+        '''Хэши блоков последней записанной копии (по времени манифеста)'''
+        if not self.manifests_dir.is_dir(): return set()
+        with os.scandir(self.manifests_dir) as items:
+            manifests = [
+                (item.stat().st_mtime, item.name) for item in items
+                if item.name.endswith('.json')
+            ]
+        if not manifests: return set()
+        try:
+            return set(self.read_manifest(max(manifests)[1][:-5])['blocks'])
+        except (OSError, ValueError, KeyError):
+            return set()
+
+
+    def _gc_mark(self, wait=False, timeout=60):
+        '''Отметка сборки мусора. При wait ожидается завершение идущей
+        сборки (она прерывается, обнаружив отметку о записи)'''
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                mark = self.gc_file.read_text(encoding='utf-8')
+            except FileNotFoundError:
+                return ''
+            if not (wait and mark.endswith(' running')): return mark
+            if time.monotonic() > deadline: return mark
+            time.sleep(0.5)
+
+
+    def _saving(self):
+        '''Есть ли незавершенная запись копии (без устаревших отметок)'''
+        if not self.pending_dir.is_dir(): return False
+        now = time.time()
+        for path in self.pending_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime < self.pending_timeout:
+                    return True
+            except FileNotFoundError:
+                continue
+        return False
+
+
+    def restore(self, name, target_file):
+        '''Собирает файл копии name из блоков с проверкой хэша'''
+        manifest = self.read_manifest(name)
+        target_file = Path(target_file)
+        part_file = target_file.with_name(target_file.name + '.part')
+        file_hash = sha256()
+        try:
+            with open(part_file, 'wb') as file:
+                for digest in manifest['blocks']:
+                    block = self._block_path(digest).read_bytes()
+                    if sha256(block).hexdigest() != digest:
+                        raise ValueError(f'Поврежден блок {digest}')
+                    file_hash.update(block)
+                    file.write(block)
+            if file_hash.hexdigest() != manifest['sha256']:
+                raise ValueError(
+                    f'Контрольная сумма копии {name} не совпадает'
+                )
+        except Exception:
+            part_file.unlink(missing_ok=True)
+            raise
+        part_file.replace(target_file)
+
+
+    def delete(self, name):
+        '''Удаляет манифест копии (блоки удаляет gc)'''
+        self._manifest_path(name).unlink(missing_ok=True)
+
+
+    def gc(self):
+        '''Удаляет блоки, на которые не ссылается ни один манифест.
+        Не выполняется и прерывается, пока на каком-либо рабочем месте
+        идет запись копии; недавно записанные блоки (моложе min_block_age)
+        не удаляются. Возвращает количество удаленных блоков'''
+        if not self.blocks_dir.is_dir() or self._saving(): return 0
+        # Запись, начатая во время сборки, увидит новую отметку и
+        # проверит свои блоки
+        _write_atomic(
+            self.gc_file, f'{uuid.uuid4().hex} running'.encode('utf-8')
+        )
+        deleted = 0
+        try:
+            referenced = self._referenced_blocks()
+            for folder in sorted(self.blocks_dir.iterdir()):
+                if self._saving(): break
+                for path in folder.iterdir():
+                    if path.name in referenced: continue
+                    try:
+                        age = time.time() - path.stat().st_mtime
+                        if age < self.min_block_age: continue
+                        path.unlink()
+                    except FileNotFoundError:
+                        continue
+                    deleted += 1
+        finally:
+            _write_atomic(
+                self.gc_file, f'{uuid.uuid4().hex} done'.encode('utf-8')
+            )
+        return deleted
+
+
+def _write_atomic(path, data):
+    '''Запись через временный файл и переименование'''
+    part_file = path.with_name(path.name + '.part')
+    part_file.write_bytes(data)
+    part_file.replace(path)
+
+
+def main(argv=None):
+    '''Командная строка: список копий и восстановление копии'''
+    parser = argparse.ArgumentParser(
+        description='Резервные копии БД с дедупликацией по блокам'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    list_parser = commands.add_parser('list', help='список копий')
+    list_parser.add_argument('store')
+    restore_parser = commands.add_parser('restore', help='восстановить копию')
+    restore_parser.add_argument('store')
+    restore_parser.add_argument('name')
+    restore_parser.add_argument('target')
+    args = parser.parse_args(argv)
+
+    store = BlockStore(args.store)
+    if args.command == 'list':
+        for name in store.manifests():
+            print(f'{name}\t{store.read_manifest(name)["size"]} байт')
+    else:
+        store.restore(args.name, args.target)
+        print(f'Копия {args.name} восстановлена в {args.target}')
+
+
+if __name__ == '__main__':
+    main()
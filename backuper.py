@@ -1,10 +1,17 @@
 '''Реализовано резервное копирование файла базы данных на сетевой папке и локальном компьютере'''
 
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha256
+import json
 from pathlib import Path
+from queue import Empty, Queue
 import shutil
+import sqlite3
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, sleep
 from tkinter.messagebox import showerror
-import re
 
 # Мои модули
 from app_data import (
@@ -13,11 +20,22 @@ from app_data import (
     ERROR_MSG,
     DATE_FILE_FORMAT,
 )
+from .backup_compress import (
+    CHECKSUM_SUFFIX, SUFFIXES, checksum_path, compress_file,
+)
+from .backup_retention import RetentionEngine, RetentionPolicy
+from .backup_store import BlockStore
 
 class Backuper:
-    '''Класс для бэкапа файла БД'''
-    def __init__(self, app):
-        # Получение логгера
+    '''Класс для бэкапа файла БД. Копирование начинается сразу при создании,
+    поэтому режимы копирования задаются параметрами:
+    Backuper(app, compress='gzip') или Backuper(app, incremental=True)'''
+    def __init__(
+        self, app, compress=None, compress_workers=4, incremental=False,
+        retention_dry_run=False,
+    ):
+        # Главное окно (опрос очереди сообщений) и логгер
+        self.app = app
         self.logger = app.logger
 
         # Получение сегодняшней даты
@@ -27,6 +45,17 @@ class Backuper:
         self.backups_days = 7
         # Количество резервных копий (не менее)
         self.backups_count = 3
+        # Количество недель и месяцев, для которых хранится последняя копия
+        self.weekly_backups = 4
+        self.monthly_backups = 3
+        # Только вывод плана удаления копий в лог, без удаления
+        self.retention_dry_run = retention_dry_run
+
+        # Копирование БД по backup_pages страниц с паузой backup_sleep
+        # секунд между шагами, чтобы не блокировать запись другим
+        # пользователям
+        self.backup_pages = 256
+        self.backup_sleep = 0.005
         
         # Имя файла и папки резервной копии
         self.prefix_file_name = 'dh_db_backup_at_'
@@ -34,100 +63,297 @@ class Backuper:
             f'{self.prefix_file_name}{self.today.strftime(DATE_FILE_FORMAT)}'
         )
         self.dir_name = 'dh_backup'
+
+        # Сжатие полных копий: None, 'gzip' или 'xz', потоков сжатия
+        if compress is not None and compress not in SUFFIXES:
+            raise ValueError(f'Неизвестный метод сжатия: {compress}')
+        self.compress = compress
+        self.compress_workers = compress_workers
+
+        # Инкрементальные копии в хранилище блоков вместо полных копий
+        self.incremental = incremental
+        self.store_dir_name = 'dh_backup_blocks'
         
         # Путь к БД
         self.db_path_dir = Path(DB_PATH_DIR)
         self.db_path_file = self.db_path_dir / DB_FILE_NAME
+        # Локальная папка и файл с отпечатком БД последнего копирования
+        self.local_dir = Path.home() / 'Documents' / 'HEP_cab_db'
+        self.state_file = self.local_dir / 'dh_backup_state.json'
 
-        # Создание резервных копий и удаление устаревших
-        self._create_server_backup()
-        self._create_local_backup()
+        # Сообщения фонового копирования для главного окна: (вид, текст)
+        self.messages = Queue()
+        self.poll_ms = 200
+        # Вызывается в главном потоке с текстом о ходе копирования
+        self.status_callback = None
+        self.done = False
 
+        # Создание резервных копий и удаление устаревших в фоне
+        self.start()
 
-    def _create_server_backup(self):
-        '''Создает резервную копию на сервере'''
-        backup_file_server = self.db_path_dir / self.dir_name / self.file_name
-        backup_dir_server = self.db_path_dir / self.dir_name
-        self._create(backup_file_server)
-        self._delete_old_backups(backup_dir_server)
-
-    
-    def _create_local_backup(self):
-        '''Создает резервную копию на докальном диске'''
-        # Путь к резервной копии
-        backup_dir_local = (
-            Path.home() / 'Documents' / 'HEP_cab_db' / self.dir_name
-        )
-        # Создание локальной папки
-        try:
-            backup_dir_local.mkdir(parents=True, exist_ok=True)
-        except Exception as err:
-            self._error_handler(
-                'Ошибка при создании локальной папки для резервных копий', err
-            )
-            return
-            
-        backup_file_local = backup_dir_local / self.file_name
 
-        self._create(backup_file_local)
-        self._delete_old_backups(backup_dir_local)
+    def start(self):
+        '''Запускает копирование в фоновом потоке и опрос сообщений'''
+        Thread(target=self._run, name='backup', daemon=True).start()
+        self.app.after(self.poll_ms, self._poll_messages)
 
 
-    def _create(self, backup_file):
-        '''Создание резервной копии'''
-        # Проверка наличия резервной копии сегодняшнего числа
-        if backup_file.is_file():
-            self.logger.info('Резервная копия БД уже существует')
-            return
-        
-        # Создание резервной копии БД
+    def _run(self):
+        '''Копирование в фоновом потоке: один снимок БД записывается
+        в папки на сервере и на локальном диске параллельно'''
+        start = perf_counter()
         try:
             if not self.db_path_file.is_file():
                 raise FileNotFoundError(
                     f'По пути {self.db_path_file} файл БД не найден'
                 )
-            shutil.copy(self.db_path_file, backup_file)
-            self.logger.info(f'Создана резервная копия БД. Путь: {backup_file}')
+            fingerprint = self._fingerprint()
+            if fingerprint == self._last_fingerprint():
+                self._report('БД не изменилась с последней резервной копии')
+                return
+            targets = self._pending_targets()
+            if not targets:
+                self._report('Резервная копия БД уже существует')
+                return
+            with TemporaryDirectory() as tmp_dir:
+                snapshot = Path(tmp_dir) / DB_FILE_NAME
+                self._report('Создание снимка БД')
+                self._online_backup(snapshot)
+                with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+                    saved = list(executor.map(
+                        lambda backup_dir: self._save_target(
+                            snapshot, backup_dir
+                        ),
+                        targets
+                    ))
+            if all(saved): self._save_fingerprint(fingerprint)
+            self._report(
+                f'Резервное копирование завершено за '
+                f'{perf_counter() - start:.1f} с'
+            )
+        except Exception as err:
+            self._error_handler('Ошибка при создании резервной копии БД', err)
+        finally:
+            self.messages.put(('done', ''))
+
+
+    def _pending_targets(self):
+        '''Папки, в которых еще нет копии за сегодня'''
+        targets = [self.db_path_dir, self.local_dir]
+        if self.incremental:
+            targets = [folder / self.store_dir_name for folder in targets]
+            return [
+                folder for folder in targets
+                if self.file_name not in BlockStore(folder).manifests()
+            ]
+        targets = [folder / self.dir_name for folder in targets]
+        return [
+            folder for folder in targets
+            if not self._backup_file(folder).is_file()
+        ]
+
+
+    def _backup_file(self, backup_dir):
+        '''Путь копии за сегодня с учетом сжатия'''
+        suffix = SUFFIXES[self.compress] if self.compress else ''
+        return backup_dir / f'{self.file_name}{suffix}'
+
+
+    def _save_target(self, snapshot, backup_dir):
+        '''Записывает снимок в папку копий и удаляет устаревшие копии.
+        Возвращает True при успехе'''
+        start = perf_counter()
+        try:
+            backup_dir.mkdir(parents=True, exist_ok=True)
+            if self.incremental:
+                store = BlockStore(backup_dir)
+                new_blocks, written = store.save(snapshot, self.file_name)
+                self._report(
+                    f'Копия {self.file_name} сохранена в {backup_dir}: '
+                    f'новых блоков {new_blocks}, записано {written} байт '
+                    f'за {perf_counter() - start:.2f} с'
+                )
+                self._delete_old_manifests(store)
+                return True
+            backup_file = self._backup_file(backup_dir)
+            if self.compress:
+                compress_file(
+                    snapshot, backup_file, self.compress,
+                    self.compress_workers
+                )
+            else:
+                part_file = backup_file.with_name(backup_file.name + '.part')
+                shutil.copyfile(snapshot, part_file)
+                part_file.replace(backup_file)
+            self._report(
+                f'Создана резервная копия БД. Путь: {backup_file}, '
+                f'{perf_counter() - start:.2f} с'
+            )
+            self._delete_old_backups(backup_dir)
+            return True
         except Exception as err:
             self._error_handler(
-                'Ошибка при создании резервной копии БД', err
+                f'Ошибка при создании резервной копии БД в {backup_dir}', err
             )
+            return False
 
-    
-    def _delete_old_backups(self, backup_dir):
-        '''Проверяет наличие и удаляет резервные копии старше 2 недель'''
-        deleted_flag = False # Флаг о наличии удаленных файлов
-        pattern = self.prefix_file_name + r'(\d{2}_\d{2}_\d{2})'
 
+    def _fingerprint(self):
+        '''Отпечаток БД: размер и время изменения файла БД и журнала WAL,
+        хэш первой страницы. Заголовок SQLite содержит счетчик изменений
+        файла, поэтому хэш не требует чтения всей БД по сети'''
+        parts = []
+        for path in (
+            self.db_path_file,
+            self.db_path_file.with_name(self.db_path_file.name + '-wal'),
+        ):
+            if path.is_file():
+                stat = path.stat()
+                parts += [stat.st_size, stat.st_mtime_ns]
+        with open(self.db_path_file, 'rb') as file:
+            parts.append(sha256(file.read(4096)).hexdigest())
+        return parts
+
+
+    def _last_fingerprint(self):
+        '''Отпечаток БД последнего успешного копирования'''
+        try:
+            with open(self.state_file, encoding='utf-8') as file:
+                return json.load(file)['fingerprint']
+        except Exception:
+            return None
+
+
+    def _save_fingerprint(self, fingerprint):
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.state_file, 'w', encoding='utf-8') as file:
+            json.dump({'fingerprint': fingerprint}, file)
+
+
+    def _report(self, msg):
+        '''Сообщение о ходе копирования: в лог и главному окну'''
+        self.logger.info(msg)
+        self.messages.put(('status', msg))
+
+
+    def _poll_messages(self):
+        '''Опрос очереди сообщений в главном потоке'''
+        try:
+            while True:
+                kind, msg = self.messages.get_nowait()
+                if kind == 'done':
+                    self.done = True
+                    return
+                if kind == 'error':
+                    showerror(title=ERROR_MSG, message=f'{msg}. Смотрите лог')
+                elif self.status_callback:
+                    self.status_callback(msg)
+        except Empty:
+            pass
+        self.app.after(self.poll_ms, self._poll_messages)
+
+
+
+
+    def _online_backup(self, backup_file):
+        '''Копирование работающей БД через API резервного копирования
+        SQLite во временный файл .part с проверкой копии и последующим
+        переименованием'''
+        part_file = backup_file.with_name(backup_file.name + '.part')
+        # Остаток прерванного копирования
+        part_file.unlink(missing_ok=True)
+        start = perf_counter()
+        source = sqlite3.connect(self.db_path_file, timeout=15)
+        target = sqlite3.connect(part_file)
+        try:
+            source.backup(
+                target, pages=self.backup_pages,
+                progress=lambda status, remaining, total: sleep(
+                    self.backup_sleep
+                )
+            )
+            copied = perf_counter()
+            check = target.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        if check != 'ok':
+            part_file.unlink(missing_ok=True)
+            raise Exception(f'Копия БД не прошла проверку: {check}')
+        part_file.replace(backup_file)
+        self.logger.info(
+            f'Создан снимок БД. Путь: {backup_file}. Копирование '
+            f'{copied - start:.2f} с, проверка {perf_counter() - copied:.2f} с'
+        )
+
+
+    def _retention_engine(self):
+        '''План хранения копий по текущим настройкам'''
+        return RetentionEngine(
+            self.prefix_file_name, DATE_FILE_FORMAT, RetentionPolicy(
+                daily=self.backups_days,
+                weekly=self.weekly_backups,
+                monthly=self.monthly_backups,
+                min_keep=self.backups_count,
+            ), companions=(CHECKSUM_SUFFIX,)
+        )
+
+
+    def _delete_old_manifests(self, store):
+        '''Удаляет устаревшие копии хранилища блоков по плану хранения
+        и неиспользуемые блоки'''
+        engine = self._retention_engine()
+        plan = engine.plan(
+            engine.entries_from_names(store.manifests()), self.today
+        )
+        self._apply_plan(
+            engine, plan, store.root,
+            lambda entry: store.delete(entry.name)
+        )
+        if self.retention_dry_run: return
+        deleted = store.gc()
+        if deleted: self.logger.info(f'Удалено неиспользуемых блоков: {deleted}')
+
+
+    def _delete_old_backups(self, backup_dir):
+        '''Удаляет устаревшие резервные копии по плану хранения: папка
+        просматривается один раз, копии удаляются одним проходом'''
         # Проверка существования папки для бэкапа
         if not backup_dir.is_dir():
             self._error_handler(
                 f'Пути {backup_dir} для бэкапа не существует'
             )
             return
+        engine = self._retention_engine()
+        plan = engine.plan(engine.scan(backup_dir), self.today)
+        self._apply_plan(engine, plan, backup_dir, self._delete_backup_file)
 
-        # Перебор всех имен файлов в папке с резервными копиями
-        for name in (item.name for item in backup_dir.iterdir()):
-            match = re.search(pattern, name)
-            if match:
-                created_date = datetime.strptime(
-                    match.group(1), DATE_FILE_FORMAT
-                )
-                if (
-                    created_date < self.today - timedelta(self.backups_days)
-                    and len(tuple(backup_dir.iterdir())) > self.backups_count
-                ):
-                    file_path = backup_dir / name
-                    file_path.unlink() # Удаление файла
-                    self.logger.info(f'Файл {file_path} удален')
-                    deleted_flag = True
-        
-        if not deleted_flag: # Если нет удаленных файлов
+
+    @staticmethod
+    def _delete_backup_file(entry):
+        '''Удаляет файл копии вместе с файлом ее контрольной суммы'''
+        Path(entry.path).unlink()
+        checksum_path(entry.path).unlink(missing_ok=True)
+
+
+    def _apply_plan(self, engine, plan, where, delete=None):
+        '''Применяет план хранения или только выводит его в лог'''
+        if self.retention_dry_run:
+            self.logger.info(
+                f'План хранения копий в {where}:\n{engine.report(plan)}'
+            )
+            return
+        deleted, errors = engine.apply(plan, delete)
+        for entry in deleted:
+            self.logger.info(f'Копия {entry.name} удалена из {where}')
+        for entry, err in errors:
+            self._error_handler(f'Ошибка при удалении копии {entry.name}', err)
+        if not deleted and not errors: # Если нет удаленных файлов
             self.logger.info('Файлы устаревших резервных копий не найдены')
-        
-    
+
     def _error_handler(self, err_msg, err=''):
-        '''Выводит сообщения об ошибках и выводит их в лог'''
+        '''Выводит сообщения об ошибках в лог и передает их главному окну
+        (окна сообщений открываются только в главном потоке)'''
         if err: err_msg = f'{err_msg}: {err}'
         self.logger.error(err_msg)
-        showerror(title=ERROR_MSG, message=f'{err_msg}. Смотрите лог')
+        self.messages.put(('error', err_msg))
@@ -1,23 +1,101 @@
 '''Классы для работы с базой данных'''
 
 from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import date, datetime
 from tkinter.messagebox import showerror, showwarning
+from sqlalchemy import (
+    and_, func, insert, inspect, or_, select, tuple_, update,
+)
 
 # Мои модули
 from app_data import ERROR_MSG, WARNING_MSG
+from ..patient_identity import make_identity_key, patient_identity_key
+from ..patient_cache import patient_cache
+from ..patient_search_index import search_patient_ids
+from ..sql_metrics import add_rows, exclude_from_method, measure_method
+
+
+# Итог массовой записи по одной строке импорта:
+# row - номер строки, status - inserted, updated, ambiguous, duplicate,
+# invalid или error, id - id пациента в БД, error - описание ошибки
+UpsertResult = namedtuple('UpsertResult', 'row status id error')
+# Форматы даты рождения в строках импорта
+BIRTH_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y')
+# Отложенное удаление атрибута приложения
+_DELETE = object()
+
+
+def parse_birth_date(value):
+    '''Дата рождения из date, datetime или строки в одном из форматов
+    BIRTH_DATE_FORMATS. None - значение не является датой'''
+    if isinstance(value, datetime): value = value.date()
+    # Пустая дата pandas (NaT) не равна самой себе
+    if isinstance(value, date): return value if value == value else None
+    if not isinstance(value, str): return None
+    for date_format in BIRTH_DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def snapshot_patient(patient):
+    '''Копия пациента для фонового потока: поток Tk может изменять
+    исходный объект, пока идет работа с БД'''
+    snapshot = inspect(patient).mapper.class_manager.new_instance()
+    for key, value in vars(patient).items():
+        if not key.startswith('_sa_'): setattr(snapshot, key, value)
+    return snapshot
 
 
 class DataBaseHandler(ABC):
     '''Базовый класс для работы с базой данных.
-    Вызывается через call_method(app, method)'''
+    Вызывается через call_method(app, method) или в фоновом потоке
+    через call_method_async(app, method, callback)'''
+    # Атрибуты app, которые изменяют методы класса
+    _app_attrs = ('patient',)
+
     @classmethod
     def call_method(cls, app, method):
         '''Проверяет создан ли экземпляр и выполняет метод'''
         instance = cls(app)
         if instance:
-            instance._methods[method]()
+            with measure_method(f'{cls.__name__}.{method}'):
+                instance._methods[method]()
             return instance
+
+
+    @classmethod
+    def call_method_async(cls, app, method, callback=None):
+        '''Выполняет метод в фоновом потоке исполнителя app.db_executor.
+        Метод работает с копией пациента, а изменения атрибутов app
+        применяются в потоке Tk, затем callback получает экземпляр.
+        Возвращает Future с экземпляром класса'''
+        instance = cls(app)
+        if instance:
+            instance._start_background()
+            def run():
+                with measure_method(f'{cls.__name__}.{method}'):
+                    instance._methods[method]()
+                return instance
+            def deliver(instance):
+                instance._apply_app_updates()
+                if callback: callback(instance)
+            return app.db_executor.submit(run, callback=deliver)
         
+
+    @classmethod
+    def bulk_upsert(cls, app, records, batch_size=500):
+        '''Массовое добавление и обновление пациентов (импорт из CSV
+        или таблицы). Не требует загруженного пациента, не выводит окон
+        и возвращает список UpsertResult по каждой строке'''
+        # Создание экземпляра в обход проверки атрибута patient
+        instance = object.__new__(cls)
+        instance.__init__(app)
+        return instance._bulk_upsert(records, batch_size)
+
     
     def __new__(cls, app):
         '''Проверяет наличие атрибута patient у главного приложения
@@ -31,6 +109,55 @@ class DataBaseHandler(ABC):
         self._app = app
         # Доступ к логгеру
         self._logger = app.logger
+        # Пациент, с которым работает метод (в фоновом потоке - копия)
+        self._patient = getattr(app, 'patient', None)
+        # Изменения атрибутов app, отложенные до возврата в поток Tk:
+        # (имя, новое значение или _DELETE, действие после изменения)
+        self._background = False
+        self._app_updates = []
+
+
+    def _start_background(self):
+        '''Готовит экземпляр к работе в фоновом потоке: запоминает
+        значения изменяемых атрибутов app и делает копию пациента'''
+        self._background = True
+        self._origins = {
+            name: getattr(self._app, name, None) for name in self._app_attrs
+        }
+        self._patient = snapshot_patient(self._app.patient)
+
+
+    def _update_app(self, name, value=_DELETE, on_apply=None):
+        '''Присваивает (или удаляет) атрибут app и вызывает on_apply
+        (например, обновление надписи пациента). Из фонового потока
+        изменение откладывается до возврата в поток Tk'''
+        if self._background:
+            self._app_updates.append((name, value, on_apply))
+            return
+        if value is _DELETE: delattr(self._app, name)
+        else: setattr(self._app, name, value)
+        if on_apply: on_apply()
+
+
+    def _apply_app_updates(self):
+        '''Применяет отложенные изменения app в потоке Tk. Изменение
+        пропускается, если за время работы метода атрибут был изменен
+        в интерфейсе (например, введен другой пациент)'''
+        for name, value, on_apply in self._app_updates:
+            if getattr(self._app, name, None) is not self._origins[name]:
+                self._logger.warning(
+                    f'Атрибут {name} изменен во время операции с БД, '
+                    'результат операции не применен'
+                )
+                continue
+            if value is _DELETE:
+                if hasattr(self._app, name): delattr(self._app, name)
+                self._origins[name] = None
+            else:
+                setattr(self._app, name, value)
+                self._origins[name] = value
+            if on_apply: on_apply()
+        self._app_updates = []
     
 
     @property
@@ -57,19 +184,27 @@ class DataBaseHandler(ABC):
     def _find_patient(self):
         '''Поиск пациента в базе'''
         try:
+            patient = self._patient
+            db_cls = self._db_cls
             with self._session() as db:
-                patients = db.query(self._db_cls).filter(
-                    self._db_cls.surname == self._app.patient.surname
-                ).filter(
-                    self._db_cls.name == self._app.patient.name
-                ).filter(
-                    self._db_cls.patronymic == self._app.patient.patronymic
-                ).filter(
-                    self._db_cls.birth_date == self._app.patient.birth_date
-                ).all()
+                # Поиск по индексу нормализованного ключа ФИО и даты
+                # рождения, а для строк без ключа (не заполненного миграцией
+                # или записанного прежней версией программы) - по полям
+                patients = db.query(db_cls).filter(or_(
+                    db_cls.identity_key == patient_identity_key(patient),
+                    and_(
+                        db_cls.identity_key.is_(None),
+                        db_cls.surname == patient.surname,
+                        db_cls.name == patient.name,
+                        db_cls.patronymic == patient.patronymic,
+                        db_cls.birth_date == patient.birth_date,
+                    )
+                )).all()
+            add_rows(len(patients))
         except Exception as err:
             self._logger.error(f'Ошибка поиска в БД: {repr(err)}')
-            showerror(
+            self._ui(
+                showerror,
                 title=ERROR_MSG,
                 message='Ошибка поиска в БД. Смотрите лог'
             )
@@ -77,6 +212,214 @@ class DataBaseHandler(ABC):
         else: return patients
 
     
+    @classmethod
+    def search(cls, app, query, limit=10):
+        '''Нечеткий поиск пациентов по частично введенным ФИО и дате
+        рождения. Возвращает до limit пациентов в порядке релевантности
+        для списка выбора'''
+        instance = object.__new__(cls)
+        instance.__init__(app)
+        return instance._search_patients(query, limit)
+
+
+    def _search_patients(self, query, limit):
+        '''Поиск кандидатов по индексу FTS5 и загрузка их из БД'''
+        try:
+            with self._session() as db:
+                ids = search_patient_ids(
+                    db, self._db_cls.__tablename__, query, limit
+                )
+                patients = {
+                    patient.id: patient for patient in db.query(
+                        self._db_cls
+                    ).filter(self._db_cls.id.in_(ids)).all()
+                }
+        except Exception as err:
+            self._logger.error(f'Ошибка поиска в БД: {repr(err)}')
+            return []
+        # Порядок релевантности из индекса
+        return [patients[db_id] for db_id in ids if db_id in patients]
+
+
+    def _find_patient_cached(self):
+        '''Поиск пациента с использованием карты загруженных пациентов.
+        Снимок из памяти возвращается без обращения к БД, а после
+        истечения срока - после сверки версии строки'''
+        key = patient_identity_key(self._patient)
+        cached = patient_cache.lookup(self._db_cls, key)
+        if cached is not None:
+            pk, snapshot, stale = cached
+            if not stale or self._is_same_version(pk, snapshot):
+                return [patient_cache.materialize(self._db_cls, snapshot)]
+            patient_cache.invalidate(self._db_cls, pk)
+        # Поиск в БД и сохранение единственного найденного пациента
+        patients = self._find_patient()
+        if patients != 'error' and len(patients) == 1:
+            patient_cache.put(patients[0])
+        return patients
+
+
+    def _is_same_version(self, pk, snapshot):
+        '''Сверяет версию снимка с версией строки в БД'''
+        try:
+            with self._session() as db:
+                updated_at = db.scalar(
+                    select(self._db_cls.updated_at).where(
+                        self._db_cls.id == pk
+                    )
+                )
+        except Exception as err:
+            self._logger.warning(f'Ошибка проверки версии: {repr(err)}')
+            return False
+        # Пустая версия - строка вставлена старой версией программы,
+        # такой строке кэш не доверяет
+        if updated_at is None or updated_at != snapshot['updated_at']:
+            return False
+        patient_cache.mark_checked(self._db_cls, pk)
+        return True
+
+
+    def _bulk_upsert(self, records, batch_size):
+        '''Сопоставляет строки импорта с базой одним запросом на пакет
+        и записывает их пакетными транзакциями'''
+        records = list(records)
+        results = [None] * len(records)
+        columns = set(self._db_cls.__table__.columns.keys())
+        # Проверка строк и расчет ключей личности
+        keyed = {}
+        for i, record in enumerate(records):
+            record, error = self._validate_record(record, columns)
+            if error:
+                results[i] = UpsertResult(i, 'invalid', None, error)
+                continue
+            # Копия строки с датой рождения в виде date
+            records[i] = record
+            key = make_identity_key(
+                record['surname'],
+                record['name'],
+                record['patronymic'],
+                record['birth_date'],
+            )
+            # Повтор пациента в самом импорте
+            if key in keyed:
+                results[i] = UpsertResult(
+                    i, 'duplicate', None, f'Повтор строки {keyed[key]}'
+                )
+                continue
+            keyed[key] = i
+
+        items = list(keyed.items())
+        for start in range(0, len(items), batch_size):
+            self._upsert_batch(
+                records, results, items[start:start + batch_size]
+            )
+
+        # Итог в лог
+        counts = {}
+        for result in results:
+            counts[result.status] = counts.get(result.status, 0) + 1
+        self._logger.info(f'Массовая запись пациентов: {counts}')
+        return results
+
+
+    @staticmethod
+    def _validate_record(record, columns):
+        '''Проверяет строку импорта. Возвращает (копия строки с датой
+        рождения в виде date, None) или (None, текст ошибки)'''
+        unknown = set(record) - columns
+        if unknown:
+            return None, f'Неизвестные поля: {", ".join(sorted(unknown))}'
+        missed = [
+            field for field in ('surname', 'name', 'patronymic', 'birth_date')
+            if field not in record
+        ]
+        if missed: return None, f'Отсутствуют поля: {", ".join(missed)}'
+        for field in ('surname', 'name'):
+            if not str(record[field] or '').strip():
+                return None, f'Пустое поле: {field}'
+        birth_date = parse_birth_date(record['birth_date'])
+        if birth_date is None:
+            return None, f'Неверная дата рождения: {record["birth_date"]!r}'
+        return {**record, 'birth_date': birth_date}, None
+
+
+    def _upsert_batch(self, records, results, batch):
+        '''Записывает один пакет строк в отдельной транзакции'''
+        db_cls = self._db_cls
+        with self._session() as db:
+            try:
+                # Поиск уже сохраненных пациентов одним запросом
+                found = {}
+                for db_id, key in db.execute(
+                    select(db_cls.id, db_cls.identity_key).where(
+                        db_cls.identity_key.in_([key for key, _ in batch])
+                    )
+                ):
+                    found.setdefault(key, []).append(db_id)
+                # Строки без ключа (не заполненного миграцией или
+                # записанного прежней версией программы) - по полям, как
+                # в _find_patient (пустое отчество - NULL или '')
+                fields = (
+                    db_cls.surname, db_cls.name,
+                    func.coalesce(db_cls.patronymic, ''), db_cls.birth_date,
+                )
+                for db_id, *values in db.execute(
+                    select(db_cls.id, *fields).where(
+                        db_cls.identity_key.is_(None),
+                        tuple_(*fields).in_([(
+                            records[i]['surname'], records[i]['name'],
+                            records[i]['patronymic'] or '',
+                            records[i]['birth_date'],
+                        ) for _, i in batch])
+                    )
+                ):
+                    found.setdefault(
+                        make_identity_key(*values), []
+                    ).append(db_id)
+
+                to_insert, to_update, new_ids = [], [], []
+                for key, i in batch:
+                    ids = found.get(key, [])
+                    if len(ids) > 1:
+                        results[i] = UpsertResult(
+                            i, 'ambiguous', None,
+                            'Найдено более одного пациента'
+                        )
+                        continue
+                    row = {**records[i], 'identity_key': key}
+                    if ids:
+                        row['id'] = ids[0]
+                        to_update.append((i, row))
+                    else: to_insert.append((i, row))
+
+                # Пакетное обновление по первичному ключу и пакетная вставка
+                if to_update:
+                    db.execute(update(db_cls), [row for _, row in to_update])
+                if to_insert:
+                    new_ids = db.scalars(
+                        insert(db_cls).returning(
+                            db_cls.id, sort_by_parameter_order=True
+                        ),
+                        [row for _, row in to_insert]
+                    ).all()
+                db.commit()
+            except Exception as err:
+                db.rollback()
+                self._logger.error(
+                    f'Ошибка пакетной записи в БД: {repr(err)}'
+                )
+                for _, i in batch:
+                    if results[i] is None:
+                        results[i] = UpsertResult(i, 'error', None, repr(err))
+            else:
+                for i, row in to_update:
+                    # Снимок в карте пациентов устарел
+                    patient_cache.invalidate(db_cls, row['id'])
+                    results[i] = UpsertResult(i, 'updated', row['id'], None)
+                for (i, _), db_id in zip(to_insert, new_ids):
+                    results[i] = UpsertResult(i, 'inserted', db_id, None)
+
+    
     def _check_correct_finding(self, patients):
         '''Проверяет корректность результатов поиска'''
         # Ошибка при поиске
@@ -87,14 +430,16 @@ class DataBaseHandler(ABC):
         elif not patients:
             self._clear_patient_data()
             self._logger.warning('Пациент не найден')
-            showwarning(title=WARNING_MSG, message='Пациент не найден')
+            self._ui(
+                showwarning, title=WARNING_MSG, message='Пациент не найден'
+            )
             return
         # Найдено более одного пациента
         elif len(patients) > 1:
             err_msg = 'Найдено более одного пациента. Проверьте базу данных'
             self._logger.error(err_msg)
             self._clear_patient_data()
-            showerror(title=ERROR_MSG, message=err_msg)
+            self._ui(showerror, title=ERROR_MSG, message=err_msg)
             return
         # Найден один пациент
         else: return True
@@ -114,19 +459,33 @@ class DataBaseHandler(ABC):
         pass
 
 
+    def _ui(self, func, *args, **kwargs):
+        '''Вызывает функцию интерфейса (окна сообщений, виджеты) в потоке Tk.
+        Из фонового потока вызов передается через очередь исполнителя.
+        Время вызова (в том числе ожидание ответа пользователя) не входит
+        в замер метода'''
+        executor = getattr(self._app, 'db_executor', None)
+        with exclude_from_method():
+            if executor is None: return func(*args, **kwargs)
+            return executor.call_in_main(func, *args, **kwargs)
+
+
     def _error_log_rollback(self, db, err, msg):
         '''Сообщает об ошибке и записывает в лог, откатывает базу данных'''
         db.rollback()
         self._logger.error(f'{msg}: {repr(err)}')
-        showerror(title=ERROR_MSG, message=f'{msg}. Смотрите лог')
+        self._ui(
+            showerror, title=ERROR_MSG, message=f'{msg}. Смотрите лог'
+        )
 
 
-from sqlalchemy.orm import sessionmaker
 from tkinter.messagebox import showinfo, askyesno
 
 # Мои модули
 from app_data import WARNING_MSG, INFO_MSG, NO_PATIENT
 from ..models import PatientDH
+from ..patient_cache import patient_cache
+from ..session_registry import SessionRegistry
 from ..log_handler import log_patient_attrs
 from .base import DataBaseHandler
 
@@ -149,7 +508,7 @@ class DayHospitalHandlerDB(DataBaseHandler):
     @property
     def _session(self):
         '''Сессия для подключения к БД'''
-        return sessionmaker(autoflush=False, bind=self._app.dh_engine)
+        return SessionRegistry.get(self._app.dh_engine, self._logger)
     
 
     def __init__(self, app):
@@ -168,7 +527,8 @@ class DayHospitalHandlerDB(DataBaseHandler):
             return
         # Если такой пациент найден, запрос о перезаписи
         elif patients:
-            if askyesno(
+            if self._ui(
+                askyesno,
                 title=WARNING_MSG, 
                 message='Пациент уже есть в базе.',
                 detail='Обновить его данные?'
@@ -183,81 +543,96 @@ class DayHospitalHandlerDB(DataBaseHandler):
     def _update_patient_db(self, finded_patient):
         '''Обновляет данные пациента в базе данных'''
         # Присваивание id найденного пациента локальной версии
-        self._app.patient.id = finded_patient.id
+        self._patient.id = finded_patient.id
         # Обновление данных
         with self._session() as db:
             try:
-                saved_patient = db.merge(self._app.patient)
+                saved_patient = db.merge(self._patient)
                 db.commit()
                 db.refresh(saved_patient)
-                self._app.patient = saved_patient
+                self._update_app('patient', saved_patient)
+                # Обновление снимка в карте пациентов
+                patient_cache.put(saved_patient)
             except Exception as err:
+                patient_cache.invalidate(self._db_cls, finded_patient.id)
                 msg = 'Ошибка обновления данных в БД'
                 self._error_log_rollback(db, err, msg)
             else: 
-                showinfo(title=INFO_MSG, message='Данные пациента обновлены')
+                self._ui(
+                    showinfo,
+                    title=INFO_MSG,
+                    message='Данные пациента обновлены'
+                )
                 # Блокировка кнопки пациента
-                self.patient_button.config(state='disabled')
+                self._ui(self.patient_button.config, state='disabled')
 
     
     def _add_patient_to_db(self):
         '''Добавляет пациента в базу данных'''
         with self._session() as db:
             try:
-                db.add(self._app.patient)
+                db.add(self._patient)
                 db.commit()
-                db.refresh(self._app.patient)
+                db.refresh(self._patient)
+                self._update_app('patient', self._patient)
+                patient_cache.put(self._patient)
             except Exception as err:
                 msg = 'Ошибка записи в БД'
                 self._error_log_rollback(db, err, msg)
             else: 
-                showinfo(title=INFO_MSG, message='Пациент успешно добавлен')
+                self._ui(
+                    showinfo,
+                    title=INFO_MSG,
+                    message='Пациент успешно добавлен'
+                )
                 # Блокировка кнопки пациента
-                self.patient_button.config(state='disabled')
+                self._ui(self.patient_button.config, state='disabled')
 
     
     def _load_patient(self):
         '''Присвоение глобальной переменной атрибутов найденного пациента'''
         # Поиск и проверка корректности результатов
-        patients = self._find_patient()
+        patients = self._find_patient_cached()
         if self._check_correct_finding(patients):
-            # Присвоение найденного пациента глобальной переменной пациента
-            self._app.patient = patients[0]
-
+            patient = patients[0]
             # Смена текста надписи пациента на главном экране на текущего
             text = (
-                f'{self._app.patient.surname} {self._app.patient.name} '
-                f'{self._app.patient.patronymic} '
-                f'{self._app.patient.birth_date.strftime("%d.%m.%Y")}'
+                f'{patient.surname} {patient.name} {patient.patronymic} '
+                f'{patient.birth_date.strftime("%d.%m.%Y")}'
+            )
+            # Присвоение найденного пациента глобальной переменной пациента
+            self._update_app(
+                'patient', patient,
+                on_apply=lambda: self.patient_label.set(text)
             )
-            self.patient_label.set(text)
 
             # Внесение в лог
             self._logger.info('Загружен пациент из базы данных.')
-            log_patient_attrs(
-                self._app.patient,
-                self._logger,
-                self._app.patient.all_attrs
-            )
+            log_patient_attrs(patient, self._logger, patient.all_attrs)
 
     
     def _clear_data(self):
         '''Очищает атрибут и строку пациента на главном окне'''
-        self.patient_label.set(NO_PATIENT)
-        delattr(self._app, 'patient')
+        self._update_app(
+            'patient', on_apply=lambda: self.patient_label.set(NO_PATIENT)
+        )
         return 'patient'
     
-from sqlalchemy.orm import sessionmaker
 from tkinter.messagebox import showinfo
 
 # Мои модули
 from app_data import INFO_MSG
 from .base import DataBaseHandler
 from ..models import PatientWL
+from ..patient_cache import patient_cache
+from ..session_registry import SessionRegistry
 
 
 class WaitingListHandlerDB(DataBaseHandler):
     '''Класс для работы с БД листа ожидания'''
+    # Атрибуты app, которые изменяют методы класса
+    _app_attrs = ('patient_wl',)
+
     @property
     def _methods(self):
         '''Используемые методы в классе'''
@@ -274,42 +649,46 @@ class WaitingListHandlerDB(DataBaseHandler):
     @property
     def _session(self):
         '''Сессия для подключения к БД'''
-        return sessionmaker(autoflush=False, bind=self._app.wl_engine)
+        return SessionRegistry.get(self._app.wl_engine, self._logger)
     
 
     def __init__(self, app):
         super().__init__(app)
         # Флаг при успешном поиске пациента
         self.success_finding = False
+        # Пациент листа ожидания, найденный ранее методом load
+        self._patient_wl = getattr(app, 'patient_wl', None)
     
 
     def _clear_data(self):
         '''Очищает атрибут пациента'''
-        delattr(self._app, 'patient_wl')
+        self._update_app('patient_wl')
         return 'patient_wl'
     
 
     def _load_patient(self):
         '''Присвоение глобальной переменной атрибутов найденного пациента'''
         # Поиск и проверка корректности результатов
-        patients = self._find_patient()
+        patients = self._find_patient_cached()
         if self._check_correct_finding(patients):
             # Присвоение найденного пациента в переменную ЛС
-            self._app.patient_wl = patients[0]
+            self._update_app('patient_wl', patients[0])
             self.success_finding = True
 
     
     def _update_patient(self):
         '''Обновляет данные пациента в Листе ожидания'''
+        # Снимок пациента устаревает при любом исходе обновления
+        patient_cache.invalidate(self._db_cls, self._patient_wl.id)
         with self._session() as db:
             try:
                 result = db.query(self._db_cls).filter_by(
-                    id=self._app.patient_wl.id
+                    id=self._patient_wl.id
                 ).update(
                     {
                         'is_treating': True,
                         'budget': 'ОМС',
-                        'scheme': self._app.patient.treatment,
+                        'scheme': self._patient.treatment,
                     }
                 )
                 db.commit()
@@ -322,12 +701,14 @@ class WaitingListHandlerDB(DataBaseHandler):
                 self._error_log_rollback(db, err, msg)
             else:
                 self._logger.info(
-                    f'Данные пациента (ID: {self._app.patient_wl.id}) успешно '
+                    f'Данные пациента (ID: {self._patient_wl.id}) успешно '
                     'обновлены в Листе ожидания. Статус: взят на лечение, '
                     'бюджет - ОМС, схема лечения - '
-                    f'{self._app.patient.treatment}'
+                    f'{self._patient.treatment}'
                 )
                 self._clear_patient_data()
-                showinfo(
-                    title=INFO_MSG, message='Лист ожидания успешно обновлен'
+                self._ui(
+                    showinfo,
+                    title=INFO_MSG,
+                    message='Лист ожидания успешно обновлен'
                 )
\ No newline at end of file
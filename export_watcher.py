@@ -0,0 +1,183 @@
+'''Наблюдение за папкой, в которую анализатор выгружает CSV-файлы с результатами. Новые файлы и строки, дописанные
+в конец уже известных файлов, определяются по размеру и времени изменения, разбираются только новые байты,
+а результаты дописываются в загруженный датафрейм ResultKeeper с обновлением индексов поиска без полной перезагрузки.
+Смещение в файле сдвигается только после успешного добавления строк, перезапись файла определяется по уменьшению
+размера или изменению начала файла; уже загруженные строки перезаписанного файла повторно не добавляются.'''
+
+from hashlib import sha256
+from io import BytesIO
+from pathlib import Path
+
+
+# Размер начала файла, по хэшу которого определяется перезапись
+PREFIX_SIZE = 4096
+
+
+class _FileState:
+    '''Состояние отслеживаемого файла'''
+    def __init__(self):
+        # Смещение после последней разобранной полной строки
+        self.offset = 0
+        # Размер и время изменения при последней проверке
+        self.size = -1
+        self.mtime_ns = -1
+        # Строка заголовка CSV (добавляется к дописанным строкам)
+        self.header = b''
+        # Длина и хэш разобранного начала файла
+        self.prefix_size = 0
+        self.prefix_hash = b''
+
+
+class ExportWatcher:
+    '''Периодическая проверка папки выгрузки через root.after.
+    Использование: ExportWatcher(keeper, root, export_dir).start()'''
+    def __init__(
+        self, result_keeper, root, directory, pattern='*.csv',
+        interval_ms=2000, callback=None,
+    ):
+        self.result_keeper = result_keeper
+        self.logger = result_keeper.app.logger
+        # Виджет Tk для планирования проверок
+        self.root = root
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.interval_ms = interval_ms
+        # Вызывается с количеством добавленных строк
+        self.callback = callback
+        self._files = {}
+        self._job = None
+
+
+    def start(self, skip_existing=True):
+        '''Запускает наблюдение. При skip_existing уже существующие файлы
+        считаются загруженными, разбираются только их новые строки'''
+        if skip_existing:
+            for path in self.directory.glob(self.pattern):
+                try:
+                    self._skip(path)
+                except OSError as err:
+                    # Файл будет разобран целиком при следующей проверке
+                    self.logger.error(
+                        f'Ошибка чтения файла выгрузки {path}: {repr(err)}'
+                    )
+        self._schedule(0)
+
+
+    def stop(self):
+        '''Останавливает наблюдение'''
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+
+
+    def poll(self):
+        '''Одна проверка папки. Возвращает количество добавленных строк.
+        При ошибке чтения или разбора файла его состояние не изменяется:
+        строки разбираются повторно при следующей проверке. Строки,
+        которые уже загружены (повторы анализатора, перезаписанный файл
+        с накопленными результатами), не добавляются повторно'''
+        added = 0
+        for path in sorted(self.directory.glob(self.pattern)):
+            try:
+                added += self._poll_file(path)
+            except Exception as err:
+                self.logger.error(
+                    f'Ошибка чтения файла выгрузки {path}: {repr(err)}'
+                )
+        if added:
+            self.logger.info(f'Добавлено строк из папки выгрузки: {added}')
+            if self.callback: self.callback(added)
+        return added
+
+
+    def _poll_file(self, path):
+        '''Проверка одного файла. Возвращает количество добавленных строк'''
+        stat = path.stat()
+        state = self._files.get(path) or _FileState()
+        if (stat.st_size, stat.st_mtime_ns) == (state.size, state.mtime_ns):
+            return 0
+        if stat.st_size < state.offset or (
+            _prefix_hash(path, state.prefix_size) != state.prefix_hash
+        ):
+            # Файл перезаписан - разбор с начала
+            self.logger.warning(f'Файл выгрузки перезаписан: {path}')
+            state = _FileState()
+        data, offset, header = self._read_new_lines(path, state, stat.st_size)
+        added = 0
+        if data:
+            added = self.result_keeper.append_rows(
+                self.result_keeper.parse_csv(BytesIO(data)),
+                skip_repeated=True
+            )
+        self._commit(path, state, offset, header, stat)
+        return added
+
+
+    def _read_new_lines(self, path, state, size):
+        '''Новые полные строки файла с заголовком CSV (или b""), смещение
+        после них и заголовок. Состояние файла не изменяется. Неполная
+        последняя строка (анализатор еще пишет) остается до следующей
+        проверки'''
+        with open(path, 'rb') as file:
+            file.seek(state.offset)
+            data = file.read(size - state.offset)
+        end = data.rfind(b'\n') + 1
+        if not end: return b'', state.offset, state.header
+        data = data[:end]
+        header = state.header
+        if not header:
+            header = data[:data.find(b'\n') + 1]
+            data = data[len(header):]
+        return (
+            header + data if data.strip() else b'',
+            state.offset + end, header,
+        )
+
+
+    def _commit(self, path, state, offset, header, stat):
+        '''Сдвигает смещение после успешного разбора, запоминает размер
+        и время изменения файла и хэш разобранного начала файла'''
+        self._files[path] = state
+        state.size, state.mtime_ns = stat.st_size, stat.st_mtime_ns
+        state.offset, state.header = offset, header
+        if state.prefix_size < PREFIX_SIZE and offset > state.prefix_size:
+            state.prefix_size = min(offset, PREFIX_SIZE)
+            state.prefix_hash = _prefix_hash(path, state.prefix_size)
+
+
+    def _skip(self, path):
+        '''Отмечает файл прочитанным до последней полной строки'''
+        state = _FileState()
+        stat = path.stat()
+        with open(path, 'rb') as file:
+            header = file.readline()
+            data = file.read()
+        if not header.endswith(b'\n'):
+            # Заголовок еще не записан целиком
+            self._commit(path, state, 0, b'', stat)
+            return
+        self._commit(
+            path, state, len(header) + data.rfind(b'\n') + 1, header, stat
+        )
+
+
+    def _schedule(self, delay_ms):
+        '''Планирует следующую проверку'''
+        self._job = self.root.after(delay_ms, self._poll)
+
+
+    def _poll(self):
+        '''Проверка по таймеру: ошибки пишутся в лог, наблюдение
+        продолжается'''
+        try:
+            self.poll()
+        except Exception as err:
+            self.logger.error(f'Ошибка чтения папки выгрузки: {repr(err)}')
+        self._schedule(self.interval_ms)
+
+
+def _prefix_hash(path, size):
+    '''Хэш первых size байт файла (пустая строка при size = 0)'''
+    if not size: return b''
+    with open(path, 'rb') as file:
+        return sha256(file.read(size)).digest()
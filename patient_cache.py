@@ -0,0 +1,148 @@
+'''Карта загруженных пациентов (identity map) в памяти процесса: повторное открытие того же пациента не обращается к сетевой папке.
+Хранятся отсоединенные от сессии снимки строк с вытеснением по LRU. Запись в БД обновляет или сбрасывает снимок,
+а изменения с других рабочих мест обнаруживаются дешевой проверкой версии строки (столбец updated_at).
+Рабочие места со старой версией программы не знают о столбце updated_at и не меняют его при записи, поэтому версия
+строки обновляется триггером SQLite, а строкам, вставленным старой версией (updated_at пуст), кэш не доверяет.'''
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+from sqlalchemy import Column, DateTime, inspect, text
+from sqlalchemy.orm import make_transient_to_detached
+
+
+def _now():
+    '''Время изменения строки'''
+    return datetime.now()
+
+
+class RowVersionMixin:
+    '''Примесь к моделям PatientDH и PatientWL с версией строки'''
+    updated_at = Column(DateTime, default=_now, onupdate=_now)
+
+
+def migrate_row_version(engine, table_name):
+    '''Добавляет столбец версии строки в существующую таблицу и триггер,
+    обновляющий версию при записи строки старой версией программы.
+    Повторный запуск безопасен'''
+    with engine.begin() as conn:
+        columns = {
+            row[1] for row in conn.execute(
+                text(f'PRAGMA table_info("{table_name}")')
+            )
+        }
+        if 'updated_at' not in columns:
+            conn.execute(text(
+                f'ALTER TABLE "{table_name}" ADD COLUMN updated_at DATETIME'
+            ))
+        # Новая версия меняет updated_at сама (onupdate), старая - нет.
+        # Время записывается в формате SQLAlchemy (микросекунды)
+        conn.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS "{table_name}_row_version" '
+            f'AFTER UPDATE ON "{table_name}" '
+            f'WHEN new.updated_at IS old.updated_at BEGIN '
+            f'UPDATE "{table_name}" SET updated_at = '
+            f'strftime(\'%Y-%m-%d %H:%M:%f000\', \'now\', \'localtime\') '
+            f'WHERE id = new.id; END'
+        ))
+
+
+def migrate_row_versions(engine):
+    '''Миграция версии строки для всех таблиц моделей с RowVersionMixin,
+    которые есть в БД движка'''
+    tables = {
+        model.__tablename__ for model in RowVersionMixin.__subclasses__()
+        if hasattr(model, '__tablename__')
+    }
+    existing = set(inspect(engine).get_table_names())
+    for table_name in sorted(tables & existing):
+        migrate_row_version(engine, table_name)
+
+
+class PatientIdentityMap:
+    '''LRU-кэш снимков пациентов по классу модели и первичному ключу
+    с дополнительным поиском по ключу личности'''
+    def __init__(self, maxsize=256, revalidate_after=60.0):
+        # Максимальное количество снимков
+        self.maxsize = maxsize
+        # Время в секундах, в течение которого снимок не перепроверяется
+        self.revalidate_after = revalidate_after
+        # (класс, id) -> [ключ личности, снимок, время проверки]
+        self._entries = OrderedDict()
+        # (класс, ключ личности) -> id
+        self._keys = {}
+        self._lock = Lock()
+
+
+    def lookup(self, db_cls, identity_key):
+        '''Возвращает (id, снимок, требуется ли проверка версии) или None'''
+        with self._lock:
+            pk = self._keys.get((db_cls, identity_key))
+            if pk is None: return None
+            self._entries.move_to_end((db_cls, pk))
+            _, snapshot, checked_at = self._entries[(db_cls, pk)]
+        stale = monotonic() - checked_at > self.revalidate_after
+        return pk, snapshot, stale
+
+
+    def mark_checked(self, db_cls, pk):
+        '''Отмечает, что версия снимка подтверждена базой'''
+        with self._lock:
+            entry = self._entries.get((db_cls, pk))
+            if entry: entry[2] = monotonic()
+
+
+    def put(self, patient):
+        '''Сохраняет снимок пациента после чтения или записи в БД'''
+        db_cls = type(patient)
+        mapper = inspect(patient).mapper
+        snapshot = {
+            attr.key: getattr(patient, attr.key)
+            for attr in mapper.column_attrs
+        }
+        key = (db_cls, snapshot['id'])
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = [
+                snapshot['identity_key'], snapshot, monotonic()
+            ]
+            self._keys[(db_cls, snapshot['identity_key'])] = snapshot['id']
+            # Вытеснение давно не используемых снимков
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+
+    def invalidate(self, db_cls, pk):
+        '''Удаляет снимок пациента'''
+        with self._lock:
+            self._drop((db_cls, pk))
+
+
+    def clear(self):
+        '''Очищает карту пациентов'''
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+
+    @staticmethod
+    def materialize(db_cls, snapshot):
+        '''Создает из снимка новый отсоединенный объект модели, чтобы
+        изменения в приложении не портили кэш'''
+        patient = db_cls()
+        for name, value in snapshot.items():
+            setattr(patient, name, value)
+        make_transient_to_detached(patient)
+        return patient
+
+
+    def _drop(self, key):
+        '''Удаляет снимок и его ключ личности (вызывать под блокировкой)'''
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._keys.pop((key[0], entry[0]), None)
+
+
+# Общая карта пациентов процесса
+patient_cache = PatientIdentityMap()
@@ -0,0 +1,99 @@
+'''Нормализованный ключ личности пациента (ФИО без учета регистра и лишних пробелов + дата рождения) с индексом в таблицах
+дневного стационара и листа ожидания. Ключ пересчитывается при каждой записи в БД, поэтому поиск пациента сводится
+к одному обращению к индексу вместо полного перебора таблицы по четырем полям. Рабочие места со старой версией
+программы ключ не пересчитывают, поэтому при подключении к БД ключи, не совпадающие с ФИО и датой рождения,
+пересчитываются (вычислить ключ триггером SQLite нельзя: lower() не переводит в нижний регистр кириллицу).'''
+
+from sqlalchemy import Column, String, event, inspect, text
+from sqlalchemy.orm import Mapper
+
+
+def normalize_text(value):
+    '''Приводит строку к нижнему регистру и схлопывает пробелы'''
+    return ' '.join(str(value or '').split()).casefold()
+
+
+def make_identity_key(surname, name, patronymic, birth_date):
+    '''Формирует ключ: "фамилия имя отчество|ГГГГ-ММ-ДД"'''
+    fio = ' '.join(
+        normalize_text(part) for part in (surname, name, patronymic)
+    )
+    # Дата из ORM - объект date, из "сырого" SQL - строка ГГГГ-ММ-ДД
+    if hasattr(birth_date, 'isoformat'):
+        birth_date = birth_date.isoformat()
+    return f'{fio}|{birth_date or ""}'
+
+
+def patient_identity_key(patient):
+    '''Ключ личности для объекта пациента'''
+    return make_identity_key(
+        patient.surname,
+        patient.name,
+        patient.patronymic,
+        patient.birth_date,
+    )
+
+
+class IdentityKeyMixin:
+    '''Примесь к моделям PatientDH и PatientWL с индексируемым ключом'''
+    identity_key = Column(String, index=True)
+
+
+def _set_identity_key(mapper, connection, target):
+    '''Обновляет ключ перед вставкой и обновлением строки'''
+    if isinstance(target, IdentityKeyMixin):
+        target.identity_key = patient_identity_key(target)
+
+event.listen(Mapper, 'before_insert', _set_identity_key)
+event.listen(Mapper, 'before_update', _set_identity_key)
+
+
+def migrate_identity_key(engine, table_name, batch_size=1000):
+    '''Добавляет в существующую таблицу столбец ключа и индекс,
+    заполняет ключ у строк, где его нет (сохраненных до появления ключа)
+    или где он устарел (строка изменена старой версией программы).
+    Повторный запуск безопасен. Возвращает количество исправленных строк'''
+    with engine.begin() as conn:
+        columns = {
+            row[1] for row in conn.execute(
+                text(f'PRAGMA table_info("{table_name}")')
+            )
+        }
+        if 'identity_key' not in columns:
+            conn.execute(text(
+                f'ALTER TABLE "{table_name}" ADD COLUMN identity_key VARCHAR'
+            ))
+        conn.execute(text(
+            f'CREATE INDEX IF NOT EXISTS "ix_{table_name}_identity_key" '
+            f'ON "{table_name}" (identity_key)'
+        ))
+
+        # Сверка ключа с полями всех строк и исправление пакетами
+        rows = [
+            {'id': row[0], 'key': key}
+            for row in conn.execute(text(
+                f'SELECT id, surname, name, patronymic, birth_date, '
+                f'identity_key FROM "{table_name}"'
+            ))
+            if (key := make_identity_key(*row[1:5])) != row[5]
+        ]
+        update = text(
+            f'UPDATE "{table_name}" SET identity_key = :key WHERE id = :id'
+        )
+        for start in range(0, len(rows), batch_size):
+            conn.execute(update, rows[start:start + batch_size])
+    return len(rows)
+
+
+def migrate_identity_keys(engine):
+    '''Миграция ключа личности для всех таблиц моделей с IdentityKeyMixin,
+    которые есть в БД движка. Возвращает количество исправленных строк'''
+    tables = {
+        model.__tablename__ for model in IdentityKeyMixin.__subclasses__()
+        if hasattr(model, '__tablename__')
+    }
+    existing = set(inspect(engine).get_table_names())
+    return sum(
+        migrate_identity_key(engine, table_name)
+        for table_name in sorted(tables & existing)
+    )
@@ -0,0 +1,107 @@
+'''Нечеткий и префиксный поиск пациентов в БД по полнотекстовому индексу SQLite FTS5 с токенизатором trigram.
+Индекс строится по нормализованному ключу личности (ФИО и дата рождения) и поддерживается триггерами, поэтому
+по частично введенным или введенным с опечаткой данным за один запрос возвращается список лучших кандидатов.'''
+
+from sqlalchemy import inspect, text
+
+# Мои модули
+from .patient_identity import IdentityKeyMixin, normalize_text
+
+
+def create_fts_index(engine, table_name):
+    '''Создает индекс FTS5 и триггеры синхронизации для таблицы пациентов.
+    Повторный запуск безопасен: уже сохраненные строки заносятся в индекс
+    (полным просмотром таблицы) только при его создании. Возвращает True,
+    если индекс создан'''
+    fts = f'{table_name}_fts'
+    statements = [
+        # Индекс с внешним содержимым: текст хранится в таблице пациентов
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS "{fts}" USING fts5('
+        f'identity_key, content="{table_name}", content_rowid="id", '
+        f'tokenize="trigram")',
+        # Вставка, удаление и изменение строки пациента
+        f'CREATE TRIGGER IF NOT EXISTS "{fts}_ai" AFTER INSERT ON '
+        f'"{table_name}" BEGIN INSERT INTO "{fts}"(rowid, identity_key) '
+        f'VALUES (new.id, new.identity_key); END',
+        f'CREATE TRIGGER IF NOT EXISTS "{fts}_ad" AFTER DELETE ON '
+        f'"{table_name}" BEGIN INSERT INTO "{fts}"("{fts}", rowid, '
+        f'identity_key) VALUES (\'delete\', old.id, old.identity_key); END',
+        f'CREATE TRIGGER IF NOT EXISTS "{fts}_au" AFTER UPDATE OF '
+        f'identity_key ON "{table_name}" BEGIN '
+        f'INSERT INTO "{fts}"("{fts}", rowid, identity_key) '
+        f'VALUES (\'delete\', old.id, old.identity_key); '
+        f'INSERT INTO "{fts}"(rowid, identity_key) '
+        f'VALUES (new.id, new.identity_key); END',
+    ]
+    with engine.begin() as conn:
+        created = conn.scalar(
+            text(
+                'SELECT count(*) FROM sqlite_master '
+                'WHERE type = \'table\' AND name = :name'
+            ),
+            {'name': fts}
+        ) == 0
+        for statement in statements:
+            conn.execute(text(statement))
+        # Заполнение нового индекса по содержимому таблицы
+        if created:
+            conn.execute(text(
+                f'INSERT INTO "{fts}"("{fts}") VALUES (\'rebuild\')'
+            ))
+    return created
+
+
+def create_fts_indexes(engine):
+    '''Индексы FTS5 для всех таблиц моделей с IdentityKeyMixin,
+    которые есть в БД движка. Возвращает имена таблиц с новыми индексами'''
+    tables = {
+        model.__tablename__ for model in IdentityKeyMixin.__subclasses__()
+        if hasattr(model, '__tablename__')
+    }
+    existing = set(inspect(engine).get_table_names())
+    return [
+        table_name for table_name in sorted(tables & existing)
+        if create_fts_index(engine, table_name)
+    ]
+
+
+def _trigrams(query):
+    '''Триграммы каждого слова запроса'''
+    trigrams = []
+    for word in query.replace('|', ' ').split():
+        for i in range(len(word) - 2):
+            trigram = word[i:i + 3]
+            if trigram not in trigrams: trigrams.append(trigram)
+    return trigrams
+
+
+def search_patient_ids(conn, table_name, query, limit=10):
+    '''Возвращает id пациентов, упорядоченные по релевантности.
+    Ранжирование по числу общих триграмм (bm25) допускает опечатки,
+    для коротких запросов (инициалы) используется поиск по префиксу'''
+    # Нормализация так же, как у ключа личности
+    query = normalize_text(query)
+    if not query: return []
+    trigrams = _trigrams(query)
+    if trigrams:
+        fts = f'{table_name}_fts'
+        match = ' OR '.join(
+            '"' + trigram.replace('"', '""') + '"' for trigram in trigrams
+        )
+        rows = conn.execute(
+            text(
+                f'SELECT rowid FROM "{fts}" WHERE "{fts}" MATCH :match '
+                f'ORDER BY bm25("{fts}") LIMIT :limit'
+            ),
+            {'match': match, 'limit': limit}
+        )
+    else:
+        # Диапазон по индексу ключа личности вместо полного перебора
+        rows = conn.execute(
+            text(
+                f'SELECT id FROM "{table_name}" WHERE identity_key >= :low '
+                f'AND identity_key < :high ORDER BY identity_key LIMIT :limit'
+            ),
+            {'low': query, 'high': query + '\U0010ffff', 'limit': limit}
+        )
+    return [row[0] for row in rows]
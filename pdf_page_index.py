@@ -0,0 +1,75 @@
+'''Ленивая загрузка PDF с результатами анализов. Вместо извлечения таблиц со всех страниц сначала строится дешевый
+индекс слов текста страниц (ФИО, ID), затем таблицы извлекаются только со страниц, на которых найден пациент,
+и сохраняются для повторных запросов. Индекс слов строится постранично и останавливается, как только найден
+непрерывный блок страниц пациента.'''
+
+import pdfplumber
+
+# Мои модули
+from .search_index import normalize_id
+
+
+class PdfPageIndex:
+    '''Индекс слов страниц PDF с постраничным построением по запросу'''
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        with pdfplumber.open(pdf_path) as pdf:
+            self.pages_count = len(pdf.pages)
+        # Слова проиндексированных страниц по порядку страниц
+        self.page_tokens = []
+        # Таблицы уже извлеченных страниц: номер страницы -> таблицы
+        self._tables = {}
+
+
+    @staticmethod
+    def _tokens(text):
+        '''Нормализованные слова текста'''
+        return set(normalize_id(text or '').split())
+
+
+    @staticmethod
+    def _matches(query_tokens, page_tokens):
+        '''Каждое слово запроса является началом слова страницы'''
+        return all(
+            any(token.startswith(query) for token in page_tokens)
+            for query in query_tokens
+        )
+
+
+    def find_pages(self, query, stop_early=True):
+        '''Номера страниц, на которых есть все слова запроса. При
+        stop_early поиск заканчивается на первой странице без совпадения
+        после найденного блока страниц: отчет пациента занимает подряд
+        идущие страницы'''
+        query_tokens = normalize_id(query).split()
+        if not query_tokens: return []
+        pages = [
+            number for number, tokens in enumerate(self.page_tokens)
+            if self._matches(query_tokens, tokens)
+        ]
+        if pages and stop_early and (
+            pages[-1] + 1 < len(self.page_tokens)
+        ): return pages
+        # Индексирование оставшихся страниц
+        if len(self.page_tokens) < self.pages_count:
+            with pdfplumber.open(self.pdf_path) as pdf:
+                for page in pdf.pages[len(self.page_tokens):]:
+                    tokens = self._tokens(page.extract_text())
+                    self.page_tokens.append(tokens)
+                    number = len(self.page_tokens) - 1
+                    if self._matches(query_tokens, tokens):
+                        pages.append(number)
+                    elif pages and stop_early:
+                        break
+        return pages
+
+
+    def tables(self, pages):
+        '''Таблицы страниц в порядке страниц. Извлекаются только
+        страницы, которых еще нет в кэше'''
+        missing = [number for number in pages if number not in self._tables]
+        if missing:
+            with pdfplumber.open(self.pdf_path) as pdf:
+                for number in missing:
+                    self._tables[number] = pdf.pages[number].extract_tables()
+        return [table for number in pages for table in self._tables[number]]
@@ -4,7 +4,6 @@ from openpyxl import load_workbook
 from openpyxl.styles import Border, Side, Alignment, Font
 from tkinter.messagebox import showerror, showinfo
 from tkinter.filedialog import asksaveasfilename
-from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 
 # Мои модули
@@ -15,6 +14,7 @@ from app_data import (
     INFO_MSG,
 )
 from .models import Patient
+from .session_registry import SessionRegistry
 
 
 class ReportMaker:
@@ -40,8 +40,8 @@ class ReportMaker:
             horizontal='center', vertical='center', wrap_text=True
         )
 
-        # Создание класса сессии подключения к БД
-        self.Session = sessionmaker(autoflush=False, bind=app.engine)
+        # Фабрика сессий подключения к БД из общего реестра
+        self.Session = SessionRegistry.get(app.engine)
 
         # Доступ к логгеру
         self.logger = app.logger
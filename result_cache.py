@@ -0,0 +1,117 @@
+'''Кэш разобранных файлов с анализами на диске. Ключ кэша - путь, размер, время изменения и хэш содержимого файла,
+разобранный датафрейм хранится в двоичном столбцовом формате Feather (при наличии pyarrow, иначе pickle),
+поэтому повторное открытие той же выгрузки анализатора не требует повторного разбора CSV или PDF.
+Размер папки кэша ограничен, давно не использованные записи удаляются первыми.'''
+
+from hashlib import blake2b
+from pathlib import Path
+import os
+import pandas as pd
+
+try:
+    import pyarrow # noqa: F401 (нужен pandas для формата Feather)
+    _FEATHER = True
+except ImportError:
+    _FEATHER = False
+
+
+class ParsedResultCache:
+    '''Кэш разобранных датафреймов с ограничением размера папки (LRU)'''
+    # Версия разбора: при изменении правил разбора старые записи не читаются
+    PARSER_VERSION = 1
+
+    def __init__(
+        self, cache_dir=None, max_bytes=512 * 1024 ** 2, logger=None
+    ):
+        # Папка кэша рядом с локальными резервными копиями
+        self.cache_dir = Path(cache_dir) if cache_dir else (
+            Path.home() / 'Documents' / 'HEP_cab_db' / 'parsed_cache'
+        )
+        # Максимальный размер папки кэша в байтах
+        self.max_bytes = max_bytes
+        self.logger = logger
+
+
+    def key(self, path, options=''):
+        '''Ключ записи: путь, размер, время изменения, хэш содержимого
+        и параметры разбора'''
+        path = Path(path)
+        stat = path.stat()
+        digest = blake2b(digest_size=20)
+        digest.update(
+            f'{self.PARSER_VERSION}|{path.resolve()}|{stat.st_size}|'
+            f'{stat.st_mtime_ns}|{options}'.encode()
+        )
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 ** 2), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+    def load(self, key):
+        '''Датафрейм из кэша или None'''
+        for suffix, reader in (
+            ('.feather', pd.read_feather), ('.pkl', pd.read_pickle)
+        ):
+            entry = self.cache_dir / f'{key}{suffix}'
+            if not entry.is_file(): continue
+            try:
+                df = reader(entry)
+            except Exception as err:
+                self._log_error('Ошибка чтения кэша', err)
+                entry.unlink(missing_ok=True)
+                return None
+            # Отметка использования для вытеснения по LRU
+            os.utime(entry)
+            return df
+        return None
+
+
+    def store(self, key, df):
+        '''Сохраняет датафрейм в кэш и освобождает место при превышении
+        размера папки'''
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            entry = self._write(key, df)
+            self._evict(keep=entry)
+        except Exception as err:
+            self._log_error('Ошибка записи в кэш', err)
+
+
+    def _write(self, key, df):
+        '''Записывает файл через временное имя, чтобы другой процесс
+        не прочитал недописанную запись'''
+        if _FEATHER:
+            entry = self.cache_dir / f'{key}.feather'
+            tmp = entry.with_suffix('.tmp')
+            try:
+                df.reset_index(drop=True).to_feather(tmp)
+                tmp.replace(entry)
+                return entry
+            except Exception:
+                # Столбцы со смешанными типами Feather не поддерживает
+                tmp.unlink(missing_ok=True)
+        entry = self.cache_dir / f'{key}.pkl'
+        tmp = entry.with_suffix('.tmp')
+        df.to_pickle(tmp)
+        tmp.replace(entry)
+        return entry
+
+
+    def _evict(self, keep=None):
+        '''Удаляет давно не использованные записи сверх лимита размера'''
+        entries = [
+            (entry.stat(), entry) for entry in self.cache_dir.iterdir()
+            if entry.suffix in ('.feather', '.pkl')
+        ]
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, entry in sorted(entries, key=lambda item: item[0].st_mtime):
+            if total <= self.max_bytes: break
+            if entry == keep: continue
+            entry.unlink(missing_ok=True)
+            total -= stat.st_size
+
+
+    def _log_error(self, msg, err):
+        '''Ошибки кэша не прерывают загрузку файла, только пишутся в лог'''
+        if self.logger: self.logger.warning(f'{msg}: {repr(err)}')
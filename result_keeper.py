@@ -1,17 +1,41 @@
 '''Класс для загрузки CSV-файла, выгруженного непосредственно с анализатора крови, и преобразования в датафрейм'''
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+import os
+from pathlib import Path
+import re
+import sys
+from time import perf_counter
+import numpy as np
 import pandas as pd
-from tkinter.messagebox import showerror
-from tkinter.filedialog import askopenfilename
+from pandas.api.types import union_categoricals
+from tkinter.messagebox import showerror, showwarning
+from tkinter.filedialog import askopenfilename, askopenfilenames
 import pdfplumber
 
 # Мои модули
-from app_data import ERROR_MSG
+from app_data import ERROR_MSG, WARNING_MSG, Paraclinics
+from .pdf_page_index import PdfPageIndex
+from .result_cache import ParsedResultCache
+from .search_index import PrefixIndex, ValueIndex
+
+# Минимальное количество страниц PDF на одну задачу процесса
+PDF_PAGES_PER_TASK = 4
+# Столбцы даты и времени анализа в выгрузках: вместе с ID определяют
+# повторы одной и той же строки анализатора в разных файлах
+TIMESTAMP_COLUMNS = ('Дата', 'Время', 'Дата/время', 'Date', 'Time')
 
 
 class ResultKeeper:
     '''Класс для хранения датафреймов с результатами анализов'''
-    def __init__(self, app, load_title, encoding='utf-8', pdf=False):
+    def __init__(
+        self, app, load_title, encoding='utf-8', pdf=False, value_index=False,
+        analys=None, cache=True, pdf_workers=1, projected=False,
+        chunksize=100_000, load_workers=4, lazy_pdf=False,
+        timestamp_columns=TIMESTAMP_COLUMNS,
+    ):
         # Экземпляр приложения
         self.app = app
         # Заголовок для окна загрузки
@@ -22,18 +46,60 @@ class ResultKeeper:
         self._df = None
         # Флаг загрузки файла с анализами
         self.loaded = False
+        # Индекс поиска пациента по началу ID
+        self.id_index = None
+        # Построение индексов значений показателей (поиск по КАК) при
+        # загрузке; без флага индекс столбца строится при первом поиске
+        self.value_index = value_index
+        self.value_indexes = {}
+        # Анализ, для полей которого строится числовая матрица показателей,
+        # столбцы матрицы (в порядке полей ввода) и сама матрица
+        self.analys = analys
+        self.matrix_cols = []
+        self.matrix = None
+        # Исходный текст нечисловых значений матрицы ("<0.1", ">500"):
+        # (строка, столбец матрицы) -> текст
+        self.matrix_text = {}
         # Загрузка PDF
         self.pdf = pdf
+        # Ленивая загрузка PDF: таблицы извлекаются только со страниц,
+        # найденных по запросу (find_in_pdf)
+        self.lazy_pdf = lazy_pdf
+        self.page_index = None
+        # Количество процессов для разбора страниц PDF: по умолчанию 1 - без
+        # процессов; None - по числу ядер. Включать только в сборке, которая
+        # вызывает multiprocessing.freeze_support() (в Windows каждый процесс
+        # пула запускает программу заново)
+        self.pdf_workers = pdf_workers
+        # Загрузка из CSV только столбцов ID и показателей анализа analys
+        # частями по chunksize строк
+        self.projected = projected
+        self.chunksize = chunksize
+        # Количество потоков загрузки нескольких файлов
+        self.load_workers = load_workers
+        # Столбцы даты и времени анализа в выгрузках анализатора
+        self.timestamp_columns = tuple(timestamp_columns)
+        # Кэш разобранных файлов на диске
+        self.cache = ParsedResultCache(logger=app.logger) if cache else None
 
-    # Загрузка и получение датафрейма из файла с анализами
+    # Загрузка и получение датафрейма из файла (или списка файлов)
+    # с анализами
     @property
     def df(self):
         return self._df
     @df.setter
     def df(self, path):
         try:
-            if self.pdf: self._df = self._df_from_pdf(path)
-            else: self._df = pd.read_csv(path, encoding=self.encoding)
+            self.page_index = None
+            if isinstance(path, (list, tuple)):
+                self._df = self._load_many(path)
+            elif self.pdf and self.lazy_pdf:
+                # Таблицы не извлекаются до первого запроса
+                self.page_index = PdfPageIndex(path)
+                self._df = pd.DataFrame()
+            else:
+                self._df = self._load_cached(path)
+            self._build_indexes()
             self.loaded = True
         except Exception as err:
             self.app.logger.error(repr(err))
@@ -43,34 +109,305 @@ class ResultKeeper:
             )
     
 
+    def _load_many(self, paths):
+        '''Загружает несколько файлов параллельно в потоках, объединяет
+        их и удаляет повторяющиеся строки анализатора'''
+        start = perf_counter()
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.load_workers, len(paths)))
+        ) as executor:
+            # map возвращает датафреймы в порядке файлов
+            frames = list(executor.map(self._load_file, paths))
+        df = concat_frames(frames) if frames else pd.DataFrame()
+        rows = len(df)
+        df = drop_repeated_rows(df, self.timestamp_columns, self.app.logger)
+        self.app.logger.info(
+            f'Загружено файлов: {len(paths)}, строк: {len(df)}, повторов '
+            f'удалено: {rows - len(df)}, за {perf_counter() - start:.2f} с'
+        )
+        return df
+
+
+    def _load_file(self, path):
+        '''Загрузка одного файла из списка с указанием файла в ошибке'''
+        try:
+            return self._load_cached(path)
+        except Exception as err:
+            raise Exception(f'{path}: {repr(err)}') from err
+
+
+    def _load_cached(self, path):
+        '''Датафрейм из кэша или разбор файла с сохранением в кэш'''
+        if self.cache is None: return self._parse(path)
+        key = self.cache.key(path, self._parse_options())
+        df = self.cache.load(key)
+        if df is None:
+            df = self._parse(path)
+            self.cache.store(key, df)
+        else:
+            self.app.logger.info(f'Файл загружен из кэша: {path}')
+        return df
+
+
+    def _parse(self, path):
+        '''Разбор файла с анализами'''
+        if self.pdf: return self._df_from_pdf(path)
+        return self.parse_csv(path)
+
+
+    def parse_csv(self, source):
+        '''Разбор CSV (путь или файловый объект) по настройкам загрузки'''
+        if self.projected and self.analys:
+            return self._read_csv_projected(source)
+        return pd.read_csv(source, encoding=self.encoding)
+
+
+    def _parse_options(self):
+        '''Параметры разбора, от которых зависит результат'''
+        options = f'pdf={self.pdf}|encoding={self.encoding}'
+        if self.projected and self.analys:
+            options += f'|columns={self._projected_columns()}'
+        return options
+
+
+    def _projected_columns(self):
+        '''Столбцы, нужные для поиска: ID, показатели анализа и время
+        анализа (для удаления повторов при загрузке нескольких файлов)'''
+        return ['ID'] + [
+            val[1] for val in Paraclinics()[self.analys].values() if val[1]
+        ] + list(self.timestamp_columns)
+
+
+    def _read_csv_projected(self, path):
+        '''Читает из CSV только столбцы поиска частями: ID - category,
+        показатели - float32. В памяти одновременно находится одна часть
+        в исходном виде и уже сжатые предыдущие части'''
+        start = perf_counter()
+        header = pd.read_csv(path, encoding=self.encoding, nrows=0).columns
+        # Файловый объект после чтения заголовка возвращается в начало
+        if hasattr(path, 'seek'): path.seek(0)
+        usecols = [col for col in self._projected_columns() if col in header]
+        # ID и время анализа хранятся как category, показатели - float32
+        labels = [col for col in usecols if col == 'ID' or (
+            col in self.timestamp_columns
+        )]
+        chunks = []
+        stored = peak = dropped = 0
+        for chunk in pd.read_csv(
+            path, encoding=self.encoding, usecols=usecols,
+            dtype=str, chunksize=self.chunksize,
+        ):
+            peak = max(peak, stored + chunk.memory_usage(deep=True).sum())
+            # Столбцы читаются строками без угадывания типа по части,
+            # нечисловые отметки анализатора становятся NaN (их количество
+            # выводится в лог)
+            text = chunk.drop(columns=labels)
+            values = text.apply(
+                pd.to_numeric, errors='coerce'
+            ).astype(np.float32)
+            dropped += int((
+                values.isna() & text.apply(lambda col: col.str.strip() != '')
+                & text.notna()
+            ).to_numpy().sum())
+            for col in labels:
+                values[col] = chunk[col].astype('category')
+            chunks.append(values[usecols])
+            stored += chunks[-1].memory_usage(deep=True).sum()
+        df = concat_frames(chunks) if chunks else (
+            pd.DataFrame(columns=usecols)
+        )
+        if dropped:
+            self.app.logger.warning(
+                f'Нечисловые значения показателей пропущены при загрузке '
+                f'только столбцов поиска: {dropped}'
+            )
+        seconds = max(perf_counter() - start, 1e-9)
+        memory = df.memory_usage(deep=True).sum() / 2 ** 20
+        self.app.logger.info(
+            f'Загружено строк: {len(df)} за {seconds:.2f} с '
+            f'({len(df) / seconds:.0f} строк/с), столбцов: {len(usecols)}, '
+            f'память: {memory:.1f} МБ, пик при загрузке: '
+            f'~{max(peak, stored) / 2 ** 20:.1f} МБ'
+        )
+        return df
+
+
+    def _build_indexes(self):
+        '''Строит индексы поиска по загруженному датафрейму'''
+        self.id_index = None
+        if 'ID' in self._df.columns:
+            self.id_index = PrefixIndex(self._df['ID'])
+        # Индексы значений по всем числовым столбцам
+        self.value_indexes = {}
+        if self.value_index:
+            for col in self._df.select_dtypes('number').columns:
+                self.value_indexes[col] = ValueIndex(self._df[col])
+        # Числовая матрица показателей строится при первом поиске
+        self.matrix = None
+
+
+    def get_value_index(self, col):
+        '''Индекс значений столбца. Если индекс не построен при загрузке,
+        строится при первом обращении (в том числе для столбцов, прочитанных
+        как текст). None - столбца нет в датафрейме'''
+        value_index = self.value_indexes.get(col)
+        if value_index is None and col in self._df.columns:
+            value_index = self.value_indexes[col] = ValueIndex(self._df[col])
+        return value_index
+
+
+    def ensure_matrix(self, analys):
+        '''Строит один раз на загрузку файла непрерывную матрицу float
+        из столбцов показателей анализа в порядке полей ввода.
+        Отсутствующие столбцы заполняются NaN, о них сообщается один раз.
+        Возвращает False, если строить не из чего (файл не загружен или
+        PDF в ленивом режиме)'''
+        if self._df is None or self._df.empty: return False
+        if self.matrix is not None and self.analys == analys: return True
+        self.analys = analys
+        self.matrix_cols = [
+            val[1] for val in Paraclinics()[analys].values()
+        ]
+        self.matrix_text = {}
+        self.matrix = self._matrix_for(self._df)
+        missed = [
+            col for col in self.matrix_cols
+            if col and col not in self._df.columns
+        ]
+        if missed:
+            msg = f'Отсутствуют столбцы: {", ".join(missed)}'
+            self.app.logger.warning(msg)
+            showwarning(title=WARNING_MSG, message=msg)
+        return True
+
+
+    def _matrix_for(self, df, start=0):
+        '''Матрица показателей строк датафрейма (с началом нумерации строк
+        start). Текст нечисловых значений сохраняется в matrix_text'''
+        matrix = np.full((len(df), len(self.matrix_cols)), np.nan)
+        texts = 0
+        for j, col in enumerate(self.matrix_cols):
+            if col not in df.columns: continue
+            matrix[:, j] = _to_float64(df[col])
+            # Непустые значения, не являющиеся числом
+            text = df[col].astype(object).to_numpy()
+            for i in np.flatnonzero(np.isnan(matrix[:, j]) & pd.notna(text)):
+                value = str(text[i]).strip()
+                if value:
+                    self.matrix_text[(int(start + i), j)] = value
+                    texts += 1
+        if texts:
+            self.app.logger.info(
+                f'Нечисловые значения показателей сохранены как текст: {texts}'
+            )
+        return matrix
+
+
+    def row_values(self, position):
+        '''Значения показателей строки в порядке полей ввода: число из
+        матрицы или исходный текст нечислового значения. Матрица
+        анализа analys строится при первом обращении'''
+        if self.matrix is None: self.ensure_matrix(self.analys)
+        row = list(self.matrix[position])
+        if self.matrix_text:
+            for j in range(len(row)):
+                row[j] = self.matrix_text.get((position, j), row[j])
+        return row
+
+
+    def append_rows(self, new_df, skip_repeated=False):
+        '''Дописывает строки в конец загруженного датафрейма и обновляет
+        индексы и матрицу только для новых строк, без полной перезагрузки.
+        При skip_repeated строки, которые уже есть в датафрейме (повторы
+        по правилам drop_repeated_rows), не добавляются. Возвращает
+        количество добавленных строк'''
+        if skip_repeated:
+            new_df = drop_known_rows(
+                self._df, new_df, self.timestamp_columns, self.app.logger
+            )
+        if not len(new_df): return 0
+        if self._df is None:
+            self._df = new_df.reset_index(drop=True)
+            self._build_indexes()
+            self.loaded = True
+            return len(new_df)
+        start = len(self._df)
+        new_df = new_df.reset_index(drop=True)
+        self._df = concat_frames([self._df, new_df])
+        if self.id_index is not None and 'ID' in new_df.columns:
+            # Новый объект индекса: сессии поиска при вводе пересоздаются
+            self.id_index = self.id_index.merged(new_df['ID'], start)
+        for col, value_index in self.value_indexes.items():
+            value_index.extend(
+                new_df[col] if col in new_df.columns
+                else np.full(len(new_df), np.nan)
+            )
+        if self.matrix is not None:
+            self.matrix = np.vstack(
+                [self.matrix, self._matrix_for(new_df, start)]
+            )
+        return len(new_df)
+
+
     def _df_from_pdf(self, pdf_path):
         '''Датафрейм из PDF'''
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                all_tables = []
-                # Получение из PDF всех таблиц со всех страниц
-                for page in pdf.pages:
-                    tables = page.extract_tables()
-                    for table in tables:
-                        table_df = pd.DataFrame(table[1:], columns=table[0])
-                        all_tables.append(table_df)
-            # Объединение таблиц и форматирование столбцов Результат и Тест
-            if all_tables: 
-                joined_df = pd.concat(all_tables, ignore_index=True)
-                joined_df['Результат'] = joined_df['Результат'].apply(
-                    self._get_digit_result
-                )
-                joined_df['Тест'] = joined_df['Тест'].apply(
-                    lambda s: s.replace('\n', ' ')
-                )
-                return joined_df
+            # Получение из PDF всех таблиц со всех страниц
+            joined_df = tables_to_df(self._extract_tables(pdf_path))
+            if joined_df is not None: return joined_df
             else: raise Exception('PDF-файл не содержит таблиц')
         except Exception as err: 
             raise Exception(f'Ошибка при чтении PDF: {repr(err)}')
+
+
+    def find_in_pdf(self, query, stop_early=True):
+        '''Датафрейм таблиц страниц PDF, на которых найден запрос (ФИО, ID),
+        в ленивом режиме. Пустой датафрейм, если ничего не найдено'''
+        if self.page_index is None: return self._df
+        try:
+            pages = self.page_index.find_pages(query, stop_early)
+            df = tables_to_df(self.page_index.tables(pages))
+        except Exception as err:
+            raise Exception(f'Ошибка при чтении PDF: {repr(err)}')
+        return pd.DataFrame() if df is None else df
     
 
+    def _extract_tables(self, pdf_path):
+        '''Таблицы всех страниц PDF в порядке страниц. По умолчанию страницы
+        разбираются последовательно; при pdf_workers != 1 диапазоны страниц
+        разбираются параллельно в отдельных процессах, при ошибке пула
+        процессов - последовательно'''
+        with pdfplumber.open(pdf_path) as pdf:
+            pages_count = len(pdf.pages)
+        workers = min(
+            self.pdf_workers or os.cpu_count() or 1,
+            pages_count // PDF_PAGES_PER_TASK or 1
+        )
+        if workers <= 1: return _extract_page_tables(pdf_path, 0, pages_count)
+        # Несколько диапазонов на процесс выравнивают нагрузку
+        step = max(PDF_PAGES_PER_TASK, -(-pages_count // (workers * 4)))
+        bounds = [
+            (start, min(start + step, pages_count))
+            for start in range(0, pages_count, step)
+        ]
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # map возвращает результаты в порядке диапазонов
+                chunks = executor.map(
+                    _extract_page_tables,
+                    [pdf_path] * len(bounds), *zip(*bounds)
+                )
+                return [table for chunk in chunks for table in chunk]
+        except Exception as err:
+            self.app.logger.warning(
+                f'Параллельный разбор PDF недоступен: {repr(err)}'
+            )
+            return _extract_page_tables(pdf_path, 0, pages_count)
+
+
     def _get_digit_result(self, result):
-        '''Оставляет в колонке "Результат" только значения'''
+        '''Оставляет в колонке "Результат" только значения.
+        Поэлементный эталон для normalize_results'''
         digit_result_list = []
         # Отбор цифр и разделителя в виде точки или дефиза
         for symbol in result:
@@ -101,6 +438,161 @@ class ResultKeeper:
         else: return str(result)
 
 
+def _extract_page_tables(pdf_path, start, stop):
+    '''Таблицы страниц PDF [start, stop). Функция уровня модуля, чтобы
+    ее можно было выполнить в дочернем процессе: каждый процесс открывает
+    PDF сам. В собранном exe точка входа должна вызывать
+    multiprocessing.freeze_support()'''
+    with pdfplumber.open(pdf_path) as pdf:
+        return [
+            table for page in pdf.pages[start:stop]
+            for table in page.extract_tables()
+        ]
+
+
+def tables_to_df(tables):
+    '''Объединение таблиц PDF и форматирование столбцов Результат и Тест.
+    None, если таблиц нет'''
+    all_tables = [
+        pd.DataFrame(table[1:], columns=table[0]) for table in tables
+    ]
+    if not all_tables: return None
+    joined_df = pd.concat(all_tables, ignore_index=True)
+    joined_df['Результат'] = normalize_results(joined_df['Результат'])
+    joined_df['Тест'] = joined_df['Тест'].str.replace('\n', ' ', regex=False)
+    return joined_df
+
+
+def drop_repeated_rows(
+    df, timestamp_columns=TIMESTAMP_COLUMNS, logger=None
+):
+    '''Удаляет строки анализатора, повторяющиеся в нескольких файлах, по ID
+    и времени анализа, а без столбцов времени - полные повторы строк с ID
+    (с предупреждением в лог). Датафреймы без ID (в том числе из PDF:
+    одинаковые строки "тест - результат" бывают у разных пациентов)
+    не изменяются'''
+    if 'ID' in df.columns:
+        df = df.drop_duplicates(
+            subset=_repeat_columns(df, timestamp_columns, logger)
+        )
+    return df.reset_index(drop=True)
+
+
+def drop_known_rows(
+    df, new_df, timestamp_columns=TIMESTAMP_COLUMNS, logger=None
+):
+    '''Строки new_df без повторов друг друга и строк df (по правилам
+    drop_repeated_rows). Сравниваются только столбцы повтора'''
+    if 'ID' not in new_df.columns: return new_df
+    subset = _repeat_columns(new_df, timestamp_columns, logger)
+    if df is None or any(col not in df.columns for col in subset):
+        return new_df.drop_duplicates(subset=subset)
+    keys = pd.concat([df[subset], new_df[subset]], ignore_index=True)
+    return new_df[~keys.duplicated().to_numpy()[len(df):]]
+
+
+def _repeat_columns(df, timestamp_columns, logger):
+    '''Столбцы, по которым определяются повторы строк анализатора'''
+    stamps = [col for col in timestamp_columns if col in df.columns]
+    if stamps: return ['ID'] + stamps
+    if logger: logger.warning(
+        'В выгрузке нет столбцов времени анализа '
+        f'({", ".join(timestamp_columns)}): удаляются только полные '
+        'повторы строк'
+    )
+    return list(df.columns)
+
+
+def concat_frames(frames):
+    '''Объединяет датафреймы с результатами. Категориальные столбцы (ID,
+    время анализа) объединяются с сохранением типа category'''
+    frames = [frame for frame in frames if frame is not None]
+    df = pd.concat(frames, ignore_index=True)
+    for col in df.columns:
+        parts = [frame[col] for frame in frames if col in frame.columns]
+        if len(parts) == len(frames) and all(
+            isinstance(part.dtype, pd.CategoricalDtype) for part in parts
+        ):
+            df[col] = pd.Series(
+                union_categoricals([part.array for part in parts]),
+                index=df.index
+            )
+    return df
+
+
+def _to_float64(column):
+    '''Числовой столбец в float64. Значения float32 переводятся через
+    кратчайшую запись, чтобы 1.2 не превращалось в 1.2000000476837158'''
+    if column.dtype == np.float32:
+        return column.to_numpy().astype(str).astype(float)
+    return pd.to_numeric(column, errors='coerce')
+
+
+@lru_cache(maxsize=None)
+def _not_digit_pattern():
+    '''Шаблон символов, не являющихся цифрой (по str.isdigit), точкой или
+    дефисом. Кроме десятичных цифр \\d, isdigit истинен для надстрочных
+    и других цифр, они перечисляются явно'''
+    extra = ''.join(
+        char for char in map(chr, range(sys.maxunicode + 1))
+        if char.isdigit() and not char.isdecimal()
+    )
+    return re.compile(f'[^\\d.\\-{re.escape(extra)}]')
+
+
+def normalize_results(results):
+    '''Векторный вариант ResultKeeper._get_digit_result для всего столбца
+    "Результат": оставляет цифры, точку и дефис; диапазоны с дефисом
+    возвращаются как есть; нечисловые и нулевые значения - пустая строка;
+    при ненулевом 3-м знаке после запятой (уд.вес) - исходное число,
+    иначе незначащие нули отбрасываются'''
+    digits = pd.Series(results).fillna('').astype(str).str.replace(
+        _not_digit_pattern(), '', regex=True
+    )
+    out = pd.Series('', index=digits.index, dtype=object)
+    ranges = digits.str.contains('-', regex=False)
+    out[ranges] = digits[ranges]
+    # Строки, которые float() разбирает как число
+    numeric = ~ranges & digits.str.fullmatch(r'\d+\.?\d*|\.\d+')
+    values = digits[numeric].astype(float).to_numpy()
+    nonzero = values != 0
+    values = values[nonzero]
+    index = digits.index[numeric][nonzero]
+    if not len(values): return out
+
+    # Знаки после запятой отбрасыванием дробной части, как int()
+    first = np.fmod(np.trunc(values * 10), 10)
+    second = np.fmod(np.trunc(values * 100), 10)
+    third = np.fmod(np.trunc(values * 1000), 10)
+    # Тип object: строки '%.0f' больших чисел длиннее строк repr
+    formatted = values.astype(str).astype(object)
+    short = third == 0
+    one = short & (second == 0) & (first != 0)
+    whole = short & (second == 0) & (first == 0)
+    formatted[one] = np.char.mod('%.1f', values[one])
+    formatted[whole] = np.char.mod('%.0f', values[whole])
+    out[index] = formatted
+    return out
+
+
+def get_analysis_file_paths(title, pdf=False):
+    '''Возвращает список путей к нескольким файлам с анализами'''
+    filetypes = [('PDF-файл', '*.pdf')] if pdf else [('CSV-файл', '*.csv')]
+    return list(askopenfilenames(title=title, filetypes=filetypes))
+
+
+def analysis_files_for_period(directory, start, end, pdf=False):
+    '''Файлы с анализами из папки, измененные в период [start, end]
+    (даты включительно), в порядке времени изменения'''
+    pattern = '*.pdf' if pdf else '*.csv'
+    files = []
+    for path in Path(directory).glob(pattern):
+        mtime = path.stat().st_mtime
+        if start <= datetime.fromtimestamp(mtime).date() <= end:
+            files.append((mtime, str(path)))
+    return [path for _, path in sorted(files)]
+
+
 def get_analysis_file_path(title, pdf=False):
     '''Возвращает путь к файлу с анализами'''
     defaultextension='.csv',
@@ -13,9 +13,11 @@ from tkinter.messagebox import (
     showinfo, 
     askyesno,
 )
-import pandas as pd
+from tkinter.simpledialog import askinteger
+import numpy as np
 
 # Мои модули
+from .search_index import IncrementalSearch, rank_nearest
 from app_data import (
     Paraclinics,
     INFO_MSG,
@@ -28,6 +30,15 @@ from handlers import (
     str_to_float,
 )
 
+def format_result(value):
+    '''Значение показателя для поля ввода: пропуск и 0 - пустая строка,
+    целое число - без дробной части, текст (например, "<0.1") - как есть'''
+    if isinstance(value, str): return value
+    if np.isnan(value) or value == 0: return ''
+    if float(value).is_integer(): return str(int(value))
+    return str(float(value))
+
+
 class AnalysisSearch:
     '''Находит анализы конкретного человека, формирует список результатов
     и заполняет поля ввода'''
@@ -47,6 +58,15 @@ class AnalysisSearch:
         self._df = self.a_results[self.analys].df
         # Индекс столбца, по которому происходит поиск
         self.idx_col_search = 0
+        # Позиции строк-кандидатов КАК после предыдущих шагов поиска
+        # (None - все строки)
+        self._candidates = None
+        # Сессия поиска БАК при вводе и отложенный вызов поиска
+        self._search_session = None
+        self._pending_search = None
+        # Поля заполнены поиском при вводе (очищаются, когда введенные
+        # данные перестают однозначно указывать на этого пациента)
+        self._live_filled = False
         # Сообщения об ошибках
         self.missed_column_message = 'Отсутствует столбец: "{err}"'
         self.unknown_error_message = 'Неизвестная ошибка: "{err}"'
@@ -54,18 +74,70 @@ class AnalysisSearch:
 
     def analysis_search_BAB(self):
         '''Поиск по биохимическому анализу крови'''
-        # Получение генератора названий столбцов необходимых для поиска
-        find_cols = (val[1] for val in self.paraclinics[self.analys].values())
-        # Поиск по данным пациента
-        patient = self.tab.patient_init.get().upper()
-        finded_df = self._df[self._df['ID'].str.contains(patient)]
+        # Сессия поиска по индексу ID, построенному при загрузке файла
+        session = self._get_search_session()
+        if session is None:
+            msg = self.missed_column_message.format(err='ID')
+            self.logger.warning(msg)
+            showwarning(title=WARNING_MSG, message=msg)
+            return
+        # Поиск по началу ID пациента
+        patient = self.tab.patient_init.get()
+        positions = session.search(patient)
         # Формирование списка с анализами найденного пациента
-        finded_list = self._check_finded_df(finded_df, find_cols)
+        finded_list = self._check_finded_rows(positions)
         # Автозаполнение полей с анализами
-        if finded_list:
+        if finded_list is not None:
             self._complete_finded_results(finded_list)
 
 
+    def bind_live_search(self, delay_ms=300):
+        '''Включает автозаполнение БАК при вводе данных пациента.
+        Поиск запускается после паузы во вводе в delay_ms мс'''
+        self.tab.patient_init.trace_add(
+            'write', lambda *args: self._schedule_live_search(delay_ms)
+        )
+
+
+    def _schedule_live_search(self, delay_ms):
+        '''Откладывает поиск до окончания ввода (отменяет предыдущий)'''
+        if self._pending_search is not None:
+            self.tab.after_cancel(self._pending_search)
+        self._pending_search = self.tab.after(
+            delay_ms, self._live_search_BAB
+        )
+
+
+    def _live_search_BAB(self):
+        '''Поиск БАК при вводе: поля заполняются только при единственном
+        совпадении, без окон сообщений. Если совпадений нет или их несколько,
+        ранее заполненные при вводе поля очищаются'''
+        self._pending_search = None
+        session = self._get_search_session()
+        if session is None: return
+        positions = session.search(self.tab.patient_init.get())
+        if len(positions) == 1:
+            self._complete_finded_results(self._row_values(positions[0]))
+            self._live_filled = True
+        elif self._live_filled:
+            self._clear_finded_results()
+            self._live_filled = False
+
+
+    def _get_search_session(self):
+        '''Сессия поиска по текущему индексу ID. При перезагрузке файла
+        сессия и датафрейм обновляются'''
+        result_keeper = self.a_results[self.analys]
+        id_index = result_keeper.id_index
+        if id_index is None: return None
+        if self._search_session is None or (
+            self._search_session.index is not id_index
+        ):
+            self._search_session = IncrementalSearch(id_index)
+            self._df = result_keeper.df
+        return self._search_session
+
+
     def analysis_search_CAB(self):
         '''Поиск по клиническому анализу крови'''
         # Получение списка названий столбцов необходимых для поиска
@@ -79,22 +151,96 @@ class AnalysisSearch:
         # Получение искомого результата анализа из поля с вкладки с анализами
         # И его валидация
         result = self._get_entry_value(entry_names)
-        # Поиск по столбцу и возврат датафрейма, содержащего только строку
-        # с найденным пациентом
+        # Поиск по столбцу и возврат позиций строк-кандидатов
         if result:
-            finded_df = self._find_result_CAB(result, find_cols)
+            positions = self._find_result_CAB(result, find_cols)
         else:
             return
-        # Формирование списка с анализами из строки датафрейма
-        if finded_df is not None:
-            finded_list = self._check_finded_df(finded_df, find_cols)
+        # Формирование списка с анализами из строки матрицы
+        if positions is not None:
+            finded_list = self._check_finded_rows(positions, find_cols)
         else:
             return
         # Автозаполнение полей с анализами
-        if finded_list:
+        if finded_list is not None:
             self._complete_finded_results(finded_list)
 
 
+    def analysis_search_CAB_multi(self, top_n=5):
+        '''Поиск по КАК сразу по всем заполненным полям: строки
+        ранжируются по близости ко всем введенным значениям с учетом
+        точности ввода, вместо поочередного поиска по показателям'''
+        find_cols = [
+            val[1] 
+            for val in self.paraclinics[self.analys].values()
+            if val[1] != ''
+        ]
+        result_keeper = self.a_results[self.analys]
+        # Числовая матрица показателей строится при первом поиске
+        if not result_keeper.ensure_matrix(self.analys):
+            showinfo(title=INFO_MSG, message='Результат не найден')
+            return
+        # Введенные значения: столбец -> строка из поля ввода
+        query = {}
+        for idx, col in enumerate(find_cols):
+            entry = self.tab.entries[idx]
+            result = entry.get()
+            if result == '': continue
+            if validate_float(result) or validate_nulls(result):
+                err_text = 'Вводимые значения должны быть в виде десятичной '
+                err_text += 'дроби, разделенной точкой или запятой!'
+                showerror(title=ERROR_MSG, message=err_text)
+                entry.delete(0, END)
+                entry.insert(0, 'ERROR')
+                return
+            if col not in result_keeper.df.columns:
+                msg = self.missed_column_message.format(err=col)
+                self.logger.warning(msg)
+                showwarning(title=WARNING_MSG, message=msg)
+                continue
+            query[col] = result
+        if not query:
+            showerror(title=ERROR_MSG, message='Заполните поля для поиска')
+            return
+
+        # Допуск - половина единицы последнего введенного разряда
+        values = np.array(str_to_float(list(query.values())))
+        tolerances = np.array([
+            0.5 * 10 ** -len(result.replace(',', '.').partition('.')[2])
+            for result in query.values()
+        ])
+        matrix = result_keeper.matrix[
+            :, [result_keeper.matrix_cols.index(col) for col in query]
+        ]
+        positions, scores, exact = rank_nearest(
+            matrix, values, tolerances, top_n
+        )
+        if not len(positions):
+            showinfo(title=INFO_MSG, message='Результат не найден')
+            return
+
+        # Без подтверждения заполняется только единственное полное
+        # совпадение, иначе пользователю показывается список лучших строк
+        full_match = exact[0] == len(query)
+        unique = len(scores) == 1 or scores[1] > scores[0]
+        if not (full_match and unique):
+            detail = '\n'.join(
+                f'{i + 1}. Совпало показателей: {count} из {len(query)}, '
+                f'отклонение: {score:.1f}'
+                for i, (count, score) in enumerate(zip(exact, scores))
+            )
+            msg = (
+                'Множественное совпадение' if full_match
+                else 'Точное совпадение не найдено'
+            )
+            if not askyesno(
+                title=INFO_MSG,
+                message=f'{msg}. Заполнить поля по строке №1?',
+                detail=detail,
+            ): return
+        self._complete_finded_results(self._row_values(positions[0]))
+
+
     def _get_entry_value(self, entry_names):
         '''Получение искомого результата анализа из поля с вкладки с анализами
         и его валидация'''
@@ -122,16 +268,19 @@ class AnalysisSearch:
 
 
     def _find_result_CAB(self, result, find_cols):
-        '''Выполняет поиск по КАК и формирует список с анализами (Series) 
-        конкретного пациента'''
-        # Поиск по столбцу
+        '''Выполняет поиск по КАК и возвращает позиции строк-кандидатов'''
+        # Поиск по индексу значений столбца
         try:
-            finded_df = self._df[
-                self._df[find_cols[self.idx_col_search]] == str_to_float(
-                    [result]
-                )[0]
-            ]
-            return finded_df
+            col = find_cols[self.idx_col_search]
+            value_index = self.a_results[self.analys].get_value_index(col)
+            if value_index is None: raise KeyError(col)
+            positions = value_index.find(str_to_float([result])[0])
+            # Пересечение со строками, найденными на предыдущих шагах
+            if self._candidates is not None:
+                positions = np.intersect1d(
+                    self._candidates, positions, assume_unique=True
+                )
+            return positions
         # Если столбец не найден
         except KeyError as err:
             msg = self.missed_column_message.format(err=err.args[0])
@@ -145,21 +294,18 @@ class AnalysisSearch:
             showerror(title=ERROR_MSG, message=msg)
 
 
-    def _check_finded_df(self, finded_df, find_cols):    
-        '''Проверяет количество найденных в датафрейме строк 
-        и формирование списка найденных показателей анализов'''
+    def _check_finded_rows(self, positions, find_cols=None):
+        '''Проверяет количество найденных строк и формирует список
+        найденных показателей анализов'''
         # Если результат не найден
-        if len(finded_df.index) == 0:
+        if len(positions) == 0:
             showinfo(title=INFO_MSG, message='Результат не найден')
             if self.analys == 'КАК':
                 self._ask_to_continue_search()
         # Если найден один пациент
-        elif len(finded_df.index) == 1:
-            # Заполнение столбцов без значения нулями
-            finded_df = finded_df.fillna(0)
-            
-            # Формирование списка объектов Series с показателями анализов
-            finded_list = self._create_series(finded_df, find_cols)
+        elif len(positions) == 1:
+            # Строка матрицы с показателями анализов
+            finded_list = self._row_values(positions[0])
             
             # Если КАК - сброс поиска
             if self.analys == 'КАК': 
@@ -171,9 +317,16 @@ class AnalysisSearch:
             # отфильтрованному датафрейму будет заново проходить поиск уже
             # по следующему показателю анализа
             if self.analys == 'КАК':    
-                self.idx_col_search += 1
-                self._df = finded_df
-                add_msg = 'Заполните следующее поле'
+                self._candidates = positions
+                # Пропуск показателей, одинаковых у всех кандидатов
+                if not self._next_search_column(find_cols):
+                    # Не осталось показателя, по которому можно продолжить
+                    # поиск: строку выбирает пользователь
+                    return self._choose_candidate(positions)
+                entry_names = list(self.paraclinics[self.analys].keys())
+                add_msg = (
+                    f'Заполните поле "{entry_names[self.idx_col_search]}"'
+                )
             # В БАК поиск происходит по дополненным данным пациента
             else:
                 add_msg = 'Введите больше данных'
@@ -181,30 +334,65 @@ class AnalysisSearch:
             showinfo(title=INFO_MSG, message=msg)
 
     
-    def _create_series(self, finded_df, find_cols):
-        '''Формирует объекты Series, 
-        где одна строка (найденный пациент), 
-        состоящая из имени показателя анализа и его значения.
-        '''
-        for col in find_cols:
-            try:
-                series = finded_df[col]
-            # Если отсутствует столбец вывод ошибки,
-            # но запись столбца как пустого и продолжение цикла
-            except KeyError as err:
-                series = pd.Series({col: 0})
-                msg = self.missed_column_message.format(err=err.args[0])
-                self.logger.warning(msg)
-                showwarning(title=WARNING_MSG, message=msg)
-            # Неизвестная ошибка
-            except Exception as err:
-                msg = self.unknown_error_message.format(err=err)
-                self.logger.error(msg)
-                showerror(title=ERROR_MSG, message=msg)
-                return
-                
-            # Возврат объекта Series
-            yield series
+    def _next_search_column(self, find_cols):
+        '''Переводит поиск на следующий показатель, значения которого
+        различаются у строк-кандидатов. Возвращает False, если такого нет'''
+        result_keeper = self.a_results[self.analys]
+        for idx in range(self.idx_col_search + 1, len(find_cols)):
+            value_index = result_keeper.get_value_index(find_cols[idx])
+            if value_index is not None and value_index.can_split(
+                self._candidates
+            ):
+                self.idx_col_search = idx
+                return True
+        return False
+
+
+    def _choose_candidate(self, positions, limit=10):
+        '''Множественное совпадение, которое нельзя уточнить поиском:
+        пользователь выбирает строку по номеру в списке кандидатов с
+        различающимися показателями. Возвращает показатели выбранной
+        строки или None'''
+        self._reset_search()
+        shown = positions[:limit]
+        rows = [self._row_values(position) for position in shown]
+        entry_names = list(self.paraclinics[self.analys].keys())
+        # Показатели, значения которых различаются у кандидатов
+        differ = [
+            j for j in range(len(entry_names))
+            if len({format_result(row[j]) for row in rows}) > 1
+        ]
+        lines = [
+            f'{i + 1}. Строка {position + 1}: ' + (', '.join(
+                f'{entry_names[j]} {format_result(row[j]) or "-"}'
+                for j in differ[:4]
+            ) or 'показатели совпадают')
+            for i, (position, row) in enumerate(zip(shown, rows))
+        ]
+        if len(positions) > limit:
+            lines.append(f'... еще строк: {len(positions) - limit}')
+        choice = askinteger(
+            title=INFO_MSG,
+            prompt=(
+                f'Множественное совпадение, найдено строк: '
+                f'{len(positions)}. Показателей для продолжения поиска '
+                'нет.\n\n'
+                + '\n'.join(lines)
+                + '\n\nНомер строки для заполнения полей:'
+            ),
+            minvalue=1,
+            maxvalue=len(shown),
+        )
+        if choice is None: return None
+        return rows[choice - 1]
+
+
+    def _row_values(self, position):
+        '''Показатели найденного пациента в порядке полей ввода. Числовая
+        матрица показателей строится при первом обращении'''
+        result_keeper = self.a_results[self.analys]
+        result_keeper.ensure_matrix(self.analys)
+        return result_keeper.row_values(position)
 
 
     def _ask_to_continue_search(self):
@@ -232,20 +420,88 @@ class AnalysisSearch:
 
     
     def _reset_search(self):
-        '''Сбрасывает индекс показателей до 0 и возвращает исходный датафрейм'''
+        '''Сбрасывает индекс показателей до 0 и кандидатов поиска'''
         self.idx_col_search = 0
+        self._candidates = None
         self._df = self.a_results[self.analys].df
 
 
     def _complete_finded_results(self, finded_list):
         '''Заполняет поля ввода во вкладке найденными результатами анализов'''
-        for i, series in enumerate(finded_list):
+        matrix_cols = self.a_results[self.analys].matrix_cols
+        for i, value in enumerate(finded_list):
+            # Поля без столбца анализатора не изменяются
+            if not matrix_cols[i]: continue
             # Очистка поля ввода
             self.tab.entries[i].delete(0, END)
-            # Считывание показателя со списка результатов, если 0
-            # замена на пустую строку
-            result = series.iloc[0]
-            if result == 0:
-                result = ''
             # Ввод в поле ввода показателя анализа
-            self.tab.entries[i].insert(0, result)
+            self.tab.entries[i].insert(0, format_result(value))
+
+
+    def _clear_finded_results(self):
+        '''Очищает поля ввода, заполняемые из файла анализатора'''
+        matrix_cols = self.a_results[self.analys].matrix_cols
+        for i, col in enumerate(matrix_cols):
+            if col: self.tab.entries[i].delete(0, END)
+
+
+class BatchAnalysisSearch:
+    '''Пакетное автозаполнение анализов для списка пациентов (например,
+    всех выписываемых за день). Все пациенты ищутся одним векторным
+    запросом по индексу ID, а неоднозначные и ненайденные пациенты
+    отмечаются в результате без окон сообщений'''
+    def __init__(self, a_results, logger, analys='БАК'):
+        self.logger = logger
+        self.paraclinics = Paraclinics()
+        self.a_results = a_results
+        self.analys = analys
+
+
+    def search(self, patients):
+        '''Возвращает для каждого пациента словарь: patient - запрос,
+        status - found, ambiguous или missing, matches - число найденных
+        строк, results - значения показателей по названиям полей ввода'''
+        result_keeper = self.a_results[self.analys]
+        id_index = result_keeper.id_index
+        if id_index is None:
+            raise KeyError('ID')
+        entry_names = list(self.paraclinics[self.analys].keys())
+
+        # Диапазоны ключей всех пациентов одним векторным поиском
+        patients = list(patients)
+        lo, hi = id_index.find_many(patients)
+        counts = hi - lo
+        found = counts == 1
+
+        # Строки матрицы найденных пациентов одной выборкой
+        result_keeper.ensure_matrix(self.analys)
+        rows = iter(
+            result_keeper.row_values(position)
+            for position in id_index.positions_at(lo[found])
+        )
+
+        records = []
+        for patient, count in zip(patients, counts):
+            record = {
+                'patient': patient,
+                'status': 'found' if count == 1 else (
+                    'missing' if count == 0 else 'ambiguous'
+                ),
+                'matches': int(count),
+                'results': {},
+            }
+            if count == 1:
+                record['results'] = {
+                    name: format_result(value)
+                    for name, value in zip(entry_names, next(rows))
+                }
+            records.append(record)
+
+        statuses = [record['status'] for record in records]
+        self.logger.info(
+            f'Пакетный поиск {self.analys}: найдено '
+            f'{statuses.count("found")}, неоднозначно '
+            f'{statuses.count("ambiguous")}, не найдено '
+            f'{statuses.count("missing")}'
+        )
+        return records
@@ -0,0 +1,235 @@
+'''Индексы для быстрого поиска по датафреймам с результатами анализов. Строятся один раз при загрузке файла в ResultKeeper,
+поиск пациента по началу строки "ФАМИЛИЯ ИО ГГГГ" выполняется двоичным поиском по отсортированному массиву ID
+вместо перебора всех строк регулярным выражением.'''
+
+from bisect import bisect_left
+import numpy as np
+import pandas as pd
+
+
+def normalize_id(value):
+    '''Приводит ID пациента к верхнему регистру и схлопывает пробелы'''
+    return ' '.join(str(value).split()).upper()
+
+
+class PrefixIndex:
+    '''Отсортированный массив нормализованных ID с позициями строк
+    датафрейма для поиска по префиксу'''
+    # Символ больше любого другого: граница диапазона префикса
+    _MAX_CHAR = '\U0010ffff'
+
+    def __init__(self, values):
+        keys, positions = self._sorted_keys(values)
+        self.keys = keys.tolist()
+        self.positions = positions.tolist()
+        # Массивы NumPy для пакетного поиска создаются при первом вызове
+        self._key_array = None
+        self._position_array = None
+
+
+    @staticmethod
+    def _sorted_keys(values, start=0):
+        '''Отсортированные нормализованные ID и позиции их строк
+        (нумерация строк начинается со start)'''
+        values = pd.Series(values).reset_index(drop=True)
+        # Пустые значения (NaN, None) в индекс не попадают
+        values = values[values.notna()]
+        keys = values.astype(str).str.replace(
+            r'\s+', ' ', regex=True
+        ).str.strip().str.upper().to_numpy(dtype=str)
+        # Устойчивая сортировка сохраняет исходный порядок одинаковых ID
+        order = np.argsort(keys, kind='stable')
+        return keys[order], values.index.to_numpy()[order] + start
+
+
+    def merged(self, values, start):
+        '''Новый индекс с добавленными ID строк, дописанных в конец
+        датафрейма с позиции start. Новые ключи вставляются слиянием
+        без пересортировки всего индекса'''
+        keys, positions = self._sorted_keys(values, start)
+        old_keys = np.array(self.keys, dtype=str)
+        # Одинаковые ID: новые строки после старых
+        at = np.searchsorted(old_keys, keys, side='right')
+        index = PrefixIndex.__new__(PrefixIndex)
+        index._key_array = np.insert(
+            old_keys.astype(np.result_type(old_keys, keys)), at, keys
+        )
+        index._position_array = np.insert(
+            np.array(self.positions, dtype=np.int64), at, positions
+        )
+        index.keys = index._key_array.tolist()
+        index.positions = index._position_array.tolist()
+        return index
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    @staticmethod
+    def normalize_query(prefix):
+        '''Нормализует запрос так же, как ID. Пробел в конце запроса
+        означает законченное слово и сохраняется'''
+        tail = ' ' if prefix[-1:].isspace() and prefix.strip() else ''
+        return normalize_id(prefix) + tail
+
+
+    def range(self, prefix, lo=0, hi=None, normalized=False):
+        '''Границы [начало, конец) ключей с заданным префиксом.
+        Поиск можно сузить границами предыдущего диапазона'''
+        if not normalized: prefix = self.normalize_query(prefix)
+        if hi is None: hi = len(self.keys)
+        return (
+            bisect_left(self.keys, prefix, lo, hi),
+            bisect_left(self.keys, prefix + self._MAX_CHAR, lo, hi),
+        )
+
+
+    def find_many(self, prefixes):
+        '''Векторный поиск диапазонов ключей для списка префиксов.
+        Возвращает массивы начал и концов диапазонов'''
+        if self._key_array is None:
+            self._key_array = np.array(self.keys, dtype=str)
+            self._position_array = np.array(self.positions, dtype=np.int64)
+        queries = np.array(
+            [self.normalize_query(prefix) for prefix in prefixes], dtype=str
+        )
+        return (
+            np.searchsorted(self._key_array, queries, side='left'),
+            np.searchsorted(
+                self._key_array,
+                np.char.add(queries, self._MAX_CHAR),
+                side='left'
+            ),
+        )
+
+
+    def positions_at(self, starts):
+        '''Позиции строк для массива начал диапазонов из find_many'''
+        return self._position_array[starts]
+
+
+    def positions_in(self, lo, hi):
+        '''Позиции строк диапазона ключей в исходном порядке строк'''
+        return sorted(self.positions[lo:hi])
+
+
+    def find(self, prefix):
+        '''Позиции строк датафрейма, ID которых начинается с префикса,
+        в исходном порядке строк'''
+        return self.positions_in(*self.range(prefix))
+
+
+class IncrementalSearch:
+    '''Сессия поиска при вводе: хранит последний запрос и его диапазон
+    ключей. Если новый запрос продолжает предыдущий, поиск идет только
+    внутри найденного ранее диапазона, иначе - по всему индексу'''
+    def __init__(self, index):
+        self.index = index
+        self.reset()
+
+
+    def reset(self):
+        '''Сброс сессии к поиску по всему индексу'''
+        self._query = None
+        self._range = (0, len(self.index))
+
+
+    def search(self, query):
+        '''Позиции строк, ID которых начинается с запроса'''
+        query = self.index.normalize_query(query)
+        # Дополненный запрос уточняет предыдущий результат
+        if self._query is not None and query.startswith(self._query):
+            lo, hi = self._range
+        else:
+            lo, hi = 0, len(self.index)
+        self._range = self.index.range(query, lo, hi, normalized=True)
+        self._query = query
+        return self.index.positions_in(*self._range)
+
+
+class ValueIndex:
+    '''Инвертированный индекс столбца показателя: квантованное значение ->
+    отсортированные позиции строк. Квантование (округление до decimals
+    знаков в целое число) делает сравнение дробных значений устойчивым'''
+    # Ключ строк без значения
+    _NAN_KEY = np.iinfo(np.int64).min
+
+    def __init__(self, values, decimals=4):
+        self.scale = 10 ** decimals
+        # Ключ каждой строки (для проверки, различает ли показатель строки)
+        self.row_keys = self._quantize(values)
+        # Списки позиций по ключам
+        self.postings = self._group(self.row_keys)
+
+
+    def _quantize(self, values):
+        '''Квантованные ключи значений, пустые значения - _NAN_KEY'''
+        values = pd.to_numeric(
+            pd.Series(values), errors='coerce'
+        ).to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        row_keys = np.full(len(values), self._NAN_KEY, dtype=np.int64)
+        row_keys[valid] = np.rint(values[valid] * self.scale)
+        return row_keys
+
+
+    def _group(self, row_keys, start=0):
+        '''Позиции строк (с началом нумерации start) по ключам'''
+        positions = np.flatnonzero(row_keys != self._NAN_KEY)
+        keys = row_keys[positions]
+        order = np.argsort(keys, kind='stable')
+        keys, positions = keys[order], positions[order] + start
+        uniq, starts = np.unique(keys, return_index=True)
+        bounds = np.append(starts, len(keys))
+        return {
+            int(key): positions[bounds[i]:bounds[i + 1]]
+            for i, key in enumerate(uniq)
+        }
+
+
+    def extend(self, values):
+        '''Добавляет значения строк, дописанных в конец датафрейма.
+        Позиции новых строк больше старых, поэтому списки остаются
+        отсортированными'''
+        start = len(self.row_keys)
+        row_keys = self._quantize(values)
+        self.row_keys = np.concatenate([self.row_keys, row_keys])
+        for key, positions in self._group(row_keys, start).items():
+            old = self.postings.get(key)
+            self.postings[key] = positions if old is None else (
+                np.concatenate([old, positions])
+            )
+
+
+    def find(self, value):
+        '''Позиции строк с заданным значением показателя'''
+        key = int(np.rint(value * self.scale))
+        return self.postings.get(key, np.empty(0, dtype=np.int64))
+
+
+    def can_split(self, positions):
+        '''Различаются ли значения показателя у строк-кандидатов'''
+        keys = self.row_keys[positions]
+        return len(keys) > 1 and bool((keys != keys[0]).any())
+
+
+def rank_nearest(matrix, values, tolerances, top_n=5, nan_penalty=100.0):
+    '''Ранжирует строки матрицы показателей по близости к введенным
+    значениям сразу по всем столбцам. Отклонение измеряется в допусках
+    (отклонение в пределах допуска равно 0), пропуск значения (NaN)
+    штрафуется. Возвращает позиции лучших строк, их оценки (меньше -
+    ближе) и количество показателей, совпавших в пределах допуска'''
+    if not len(matrix):
+        empty = np.empty(0)
+        return empty.astype(np.int64), empty, empty.astype(np.int64)
+    dist = np.abs(matrix - values) / tolerances
+    exact = dist <= 1
+    dist = np.where(exact, 0.0, dist)
+    dist = np.where(np.isnan(dist), nan_penalty, np.minimum(dist, nan_penalty))
+    scores = (dist ** 2).sum(axis=1)
+    # Отбор лучших строк без полной сортировки
+    count = min(top_n, len(scores))
+    best = np.argpartition(scores, count - 1)[:count]
+    best = best[np.argsort(scores[best], kind='stable')]
+    return best, scores[best], exact[best].sum(axis=1)
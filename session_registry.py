@@ -0,0 +1,182 @@
+'''Реестр фабрик сессий для подключения к базам данных. Для каждого движка (БД дневного стационара, листа ожидания, отчетов)
+фабрика sessionmaker создается один раз на весь процесс, а настройки SQLite (PRAGMA) применяются один раз при открытии соединения пулом,
+а не при каждом нажатии кнопки. Движки SQLite создаются с пулом постоянных соединений (create_sqlite_engine).'''
+
+import ctypes
+import os
+from threading import Lock
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+# Мои модули
+from .patient_cache import migrate_row_versions
+from .patient_identity import migrate_identity_keys
+from .patient_search_index import create_fts_indexes
+from .sql_metrics import attach_engine
+
+
+# Настройки SQLite, применяемые к каждому новому соединению пула. Безопасные
+# для файла на сетевой папке: журнал отката, полная синхронизация, без
+# отображения файла в память. Режим журнала хранится в самом файле БД, поэтому
+# WAL не включается никогда: рабочее место, для которого общая БД локальна
+# (сам файловый сервер), перевело бы ее в WAL для всех сетевых клиентов, а WAL
+# требует общей памяти и через сеть не работает. journal_mode=DELETE на каждом
+# соединении возвращает в журнал отката БД, переведенную в WAL ранее
+SQLITE_PRAGMAS = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'cache_size': -16000, # Размер кэша страниц в КБ (отрицательное число)
+    'mmap_size': 0,
+    'busy_timeout': 5000, # Ожидание снятия блокировки в мс
+}
+# Настройки соединения с файлом на локальном диске (действуют только на это
+# соединение и не сохраняются в файле БД)
+LOCAL_PRAGMAS = {
+    'mmap_size': 268435456, # 256 МБ
+}
+# Сетевые файловые системы (Linux, /proc/mounts)
+NETWORK_FILESYSTEMS = (
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'ceph',
+    'glusterfs', 'lustre', 'fuse.sshfs', 'fuse.glusterfs', 'davfs',
+)
+# Тип локального несъемного диска для GetDriveTypeW (Windows)
+DRIVE_FIXED = 3
+
+
+def create_sqlite_engine(db_path, pool_size=5, max_overflow=5):
+    '''Создает движок SQLite с пулом постоянных соединений: соединения
+    (и применение PRAGMA) не открываются заново для каждой сессии'''
+    return create_engine(
+        f'sqlite:///{db_path}',
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=30,
+        # Проверка соединения перед выдачей: сетевая папка могла
+        # отключиться
+        pool_pre_ping=True,
+        # Соединения используются из разных потоков, но не одновременно
+        connect_args={'check_same_thread': False, 'timeout': 15},
+    )
+
+
+def is_local_path(path):
+    '''Проверяет, что файл находится на локальном диске. Если это
+    не удается проверить, путь считается сетевым'''
+    if not path or path.startswith(':memory:'): return False
+    # Путь UNC (\\server\share или //server/share) - сетевая папка
+    if path.startswith(('\\\\', '//')): return False
+    path = os.path.abspath(path)
+    try:
+        if os.name == 'nt':
+            # Буква диска может быть подключенной сетевой папкой (Z:\...)
+            drive = os.path.splitdrive(path)[0]
+            if not drive: return False
+            return ctypes.windll.kernel32.GetDriveTypeW(
+                drive + '\\'
+            ) == DRIVE_FIXED
+        # Тип файловой системы ближайшей точки монтирования
+        path = os.path.realpath(path)
+        fs_type = None
+        mount_len = -1
+        with open('/proc/mounts', encoding='utf-8') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3: continue
+                mount = fields[1].replace('\\040', ' ')
+                if path == mount or path.startswith(mount.rstrip('/') + '/'):
+                    if len(mount) > mount_len:
+                        mount_len, fs_type = len(mount), fields[2]
+    except Exception:
+        return False
+    return fs_type is not None and fs_type not in NETWORK_FILESYSTEMS
+
+
+class SessionRegistry:
+    '''Реестр фабрик сессий: одна фабрика на движок на весь процесс.
+    Использование: SessionRegistry.get(app.dh_engine, app.logger)'''
+    _factories = {}
+    _lock = Lock()
+
+    @classmethod
+    def get(cls, engine, logger=None):
+        '''Возвращает фабрику сессий для движка, создавая ее при первом
+        обращении'''
+        factory = cls._factories.get(engine)
+        if factory is not None: return factory
+        with cls._lock:
+            # Повторная проверка под блокировкой
+            if engine not in cls._factories:
+                cls._register(engine, logger)
+            return cls._factories[engine]
+
+
+    @classmethod
+    def _register(cls, engine, logger=None):
+        '''Подключает настройку PRAGMA к событию открытия соединения,
+        заполняет ключ личности у строк, сохраненных до его появления,
+        добавляет столбец версии строки, индекс нечеткого поиска
+        и создает фабрику сессий'''
+        if engine.dialect.name == 'sqlite':
+            pragmas = cls._pragmas_for(engine)
+            event.listen(
+                engine, 'connect',
+                lambda dbapi_conn, record: cls._apply_pragmas(
+                    dbapi_conn, pragmas
+                )
+            )
+            # Соединения, открытые до регистрации, закрываются,
+            # чтобы пул открыл новые уже с настройками
+            engine.dispose()
+        # Ошибка миграции не мешает работе: поиск пациента учитывает
+        # строки без ключа
+        try:
+            filled = migrate_identity_keys(engine)
+        except Exception as err:
+            if logger: logger.error(
+                f'Ошибка заполнения ключа личности: {repr(err)}'
+            )
+        else:
+            if filled and logger: logger.info(
+                f'Заполнен или исправлен ключ личности у строк: {filled}'
+            )
+        # Без столбца версии строки не работает ни один запрос к таблицам
+        # пациентов, поэтому ошибка передается дальше
+        migrate_row_versions(engine)
+        # Индекс нечеткого поиска создается после заполнения ключей; без
+        # него работает только точный поиск пациента
+        try:
+            created = create_fts_indexes(engine)
+        except Exception as err:
+            if logger: logger.error(
+                f'Ошибка создания индекса поиска: {repr(err)}'
+            )
+        else:
+            if created and logger: logger.info(
+                f'Создан индекс поиска для таблиц: {", ".join(created)}'
+            )
+        # Замеры запросов, если они включены
+        attach_engine(engine)
+        cls._factories[engine] = sessionmaker(autoflush=False, bind=engine)
+
+
+    @staticmethod
+    def _pragmas_for(engine):
+        '''Настройки PRAGMA с учетом расположения файла БД: отображение
+        в память только для файла на проверенно локальном диске'''
+        pragmas = dict(SQLITE_PRAGMAS)
+        if is_local_path(engine.url.database or ''):
+            pragmas.update(LOCAL_PRAGMAS)
+        return pragmas
+
+
+    @staticmethod
+    def _apply_pragmas(dbapi_conn, pragmas):
+        '''Применяет PRAGMA к соединению'''
+        cursor = dbapi_conn.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
@@ -0,0 +1,225 @@
+'''Замер времени работы с базой данных: гистограммы задержек по методам обработчиков (create, load, update) и по SQL-запросам,
+количество строк, ошибки ожидания блокировки файла БД. Запросы дольше порога пишутся в лог медленных запросов,
+при выходе из приложения в лог выводится сводка.'''
+
+import atexit
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+from sqlalchemy import event
+
+
+class LatencyHistogram:
+    '''Гистограмма задержек с фиксированными границами корзин в мс'''
+    BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        # Последняя корзина - все, что дольше последней границы
+        self.buckets = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+
+
+    def add(self, ms, rows=0):
+        '''Добавляет замер'''
+        idx = 0
+        while idx < len(self.BOUNDS_MS) and ms > self.BOUNDS_MS[idx]:
+            idx += 1
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows += rows
+
+
+    def percentile(self, share):
+        '''Верхняя граница корзины, в которую попадает перцентиль'''
+        rank = share * self.count
+        passed = 0
+        for bound, count in zip(self.BOUNDS_MS, self.buckets):
+            passed += count
+            if passed >= rank: return f'{bound}'
+        return f'>{self.BOUNDS_MS[-1]}'
+
+
+    def summary(self):
+        '''Строка сводки для лога'''
+        if not self.count: return 'нет замеров'
+        return (
+            f'вызовов {self.count}, среднее {self.total_ms / self.count:.1f} '
+            f'мс, p50 <= {self.percentile(0.5)} мс, p95 <= '
+            f'{self.percentile(0.95)} мс, макс {self.max_ms:.1f} мс, '
+            f'строк {self.rows}'
+        )
+
+
+class SqlMetrics:
+    '''Сбор замеров по движкам SQLAlchemy и методам обработчиков БД'''
+    # Признаки ошибки ожидания блокировки файла SQLite
+    LOCK_ERRORS = ('database is locked', 'database is busy')
+
+    def __init__(self, logger, slow_ms=200.0):
+        self.logger = logger
+        # Порог медленного запроса в мс
+        self.slow_ms = slow_ms
+        self.methods = {}
+        self.statements = {}
+        self.lock_waits = 0
+        self._lock = Lock()
+        self._attached = set()
+        # Текущий замеряемый метод каждого потока
+        self._local = local()
+
+
+    def attach(self, engine):
+        '''Подключает замеры к событиям движка'''
+        if id(engine) in self._attached: return
+        self._attached.add(id(engine))
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._on_error)
+
+
+    @contextmanager
+    def measure(self, name):
+        '''Замер времени метода обработчика (без времени, исключенного
+        через exclude)'''
+        previous = getattr(self._local, 'method', None)
+        # Название, количество строк, исключенное время в с
+        self._local.method = [name, 0, 0.0]
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            _, rows, excluded = self._local.method
+            ms = (perf_counter() - start - excluded) * 1000
+            self._local.method = previous
+            self._add(self.methods, name, ms, rows)
+            if ms > self.slow_ms:
+                self.logger.warning(f'Медленный метод {name}: {ms:.0f} мс')
+
+
+    @contextmanager
+    def exclude(self):
+        '''Исключает время блока из замера текущего метода (окна
+        сообщений: время ответа пользователя не относится к работе с БД)'''
+        method = getattr(self._local, 'method', None)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            if method: method[2] += perf_counter() - start
+
+
+    def add_rows(self, rows):
+        '''Учитывает строки, полученные текущим замеряемым методом'''
+        method = getattr(self._local, 'method', None)
+        if method: method[1] += rows
+
+
+    def dump(self):
+        '''Выводит сводку замеров в лог'''
+        with self._lock:
+            lines = ['Сводка замеров работы с БД:']
+            for title, table in (
+                ('Методы', self.methods), ('Запросы', self.statements)
+            ):
+                lines.append(f'{title}:')
+                for name, histogram in sorted(
+                    table.items(), key=lambda item: -item[1].total_ms
+                ):
+                    lines.append(f'  {name}: {histogram.summary()}')
+            lines.append(f'Ожиданий блокировки БД: {self.lock_waits}')
+        self.logger.info('\n'.join(lines))
+
+
+    def _add(self, table, name, ms, rows=0):
+        '''Добавляет замер в гистограмму под блокировкой'''
+        with self._lock:
+            table.setdefault(name, LatencyHistogram()).add(ms, rows)
+
+
+    def _before_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        '''Запоминает время начала запроса'''
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+    def _after_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        '''Записывает время запроса и проверяет порог медленного запроса'''
+        ms = (perf_counter() - conn.info['query_start'].pop()) * 1000
+        # Для SELECT драйвер sqlite3 не сообщает количество строк (-1)
+        rows = max(cursor.rowcount, 0)
+        name = ' '.join(statement.split())[:80]
+        self._add(self.statements, name, ms, rows)
+        if ms > self.slow_ms:
+            self.logger.warning(
+                f'Медленный запрос {ms:.0f} мс: {" ".join(statement.split())}'
+                f' | параметры: {parameters!r:.200}'
+            )
+
+
+    def _on_error(self, context):
+        '''Сброс замера при ошибке и учет ожиданий блокировки'''
+        if context.connection is not None:
+            starts = context.connection.info.get('query_start')
+            if starts: starts.pop()
+        err_text = str(context.original_exception).lower()
+        if any(msg in err_text for msg in self.LOCK_ERRORS):
+            with self._lock:
+                self.lock_waits += 1
+            self.logger.warning(
+                f'Ожидание блокировки БД: {context.original_exception}'
+            )
+
+
+# Замеры включаются вызовом enable_sql_metrics при запуске приложения
+_metrics = None
+
+
+def enable_sql_metrics(logger, slow_ms=200.0, engines=()):
+    '''Включает замеры, подключает их к движкам и выводит сводку
+    при выходе из приложения'''
+    global _metrics
+    if _metrics is None:
+        _metrics = SqlMetrics(logger, slow_ms)
+        atexit.register(_metrics.dump)
+    for engine in engines:
+        _metrics.attach(engine)
+    return _metrics
+
+
+def attach_engine(engine):
+    '''Подключает замеры к движку, если замеры включены'''
+    if _metrics is not None: _metrics.attach(engine)
+
+
+@contextmanager
+def measure_method(name):
+    '''Замер метода обработчика; без включенных замеров ничего не делает'''
+    if _metrics is None:
+        yield
+        return
+    with _metrics.measure(name):
+        yield
+
+
+@contextmanager
+def exclude_from_method():
+    '''Исключение времени блока из замера метода; без включенных замеров
+    ничего не делает'''
+    if _metrics is None:
+        yield
+        return
+    with _metrics.exclude():
+        yield
+
+
+def add_rows(rows):
+    '''Учитывает строки, полученные текущим замеряемым методом'''
+    if _metrics is not None: _metrics.add_rows(rows)
@@ -0,0 +1,56 @@
+'''Проверка векторной нормализации столбца "Результат": normalize_results должна давать тот же результат,
+что и поэлементный эталон ResultKeeper._get_digit_result, на граничных и случайных строках.'''
+
+import random
+
+import pytest
+
+try:
+    from .result_keeper import ResultKeeper, normalize_results
+except ImportError as err:
+    pytest.skip(
+        f'Модуль result_keeper недоступен: {err}', allow_module_level=True
+    )
+
+
+# Граничные значения: нули, уд.вес, диапазоны, отметки анализатора,
+# не десятичные цифры (надстрочные, арабские), несколько точек
+EDGE_CASES = [
+    '', ' ', '0', '0.0', '00', '.', '-', '--', '.0', '0.', '.5', '5.',
+    '140', '140 г/л', '5.10', '5.01', '5.001', '1.015', '1.020', '1.2',
+    '0.1', '0.05', '12.345', '99.999', '<0.1', '>500', '10-20', '-5',
+    '1..2', '1.2.3', '1,5', '1e5', 'nan', 'inf', 'abc', 'Отр.', '++',
+    '²', '5²', '٣', '١٢.٥', '１２', '12345678901234567890', '0.000',
+    '1.0000001', '123456.789', '4.35 х10^12/л',
+]
+ALPHABET = '0123456789' * 3 + '..--,, абвxе<>/^²٣１'
+
+
+def _reference(values):
+    return [ResultKeeper._get_digit_result(None, value) for value in values]
+
+
+def test_edge_cases_match_reference():
+    assert list(normalize_results(EDGE_CASES)) == _reference(EDGE_CASES)
+
+
+def test_random_strings_match_reference():
+    rng = random.Random(20240501)
+    values = [
+        ''.join(rng.choices(ALPHABET, k=rng.randint(0, 12)))
+        for _ in range(20_000)
+    ]
+    assert list(normalize_results(values)) == _reference(values)
+
+
+def test_random_numbers_match_reference():
+    rng = random.Random(7)
+    values = [
+        f'{rng.uniform(0, 10 ** rng.randint(0, 7)):.{rng.randint(0, 4)}f}'
+        for _ in range(20_000)
+    ]
+    assert list(normalize_results(values)) == _reference(values)
+
+
+def test_missing_values_are_empty():
+    assert list(normalize_results([None, float('nan')])) == ['', '']
@@ -0,0 +1,88 @@
+'''Фоновое выполнение операций с базой данных, чтобы окно приложения не зависало при медленной или заблокированной сетевой папке.
+Работа выполняется в рабочем потоке, результаты возвращаются в виде Future, а обратные вызовы и обращения к интерфейсу
+доставляются в поток Tk через очередь, которую главное окно опрашивает методом after().'''
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import current_thread
+from tkinter.messagebox import showerror
+
+# Мои модули
+from app_data import ERROR_MSG
+
+
+class TkExecutor:
+    '''Исполнитель фоновых операций с доставкой результатов в поток Tk.
+    Создается в главном окне: self.db_executor = TkExecutor(self, logger)'''
+    def __init__(self, root, logger, poll_ms=50, max_workers=1):
+        # Главное окно для опроса очереди
+        self._root = root
+        self._logger = logger
+        # Период опроса очереди в мс
+        self._poll_ms = poll_ms
+        # Один рабочий поток по умолчанию: записи в SQLite идут по очереди
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='db_worker'
+        )
+        # Очередь вызовов для потока Tk
+        self._queue = Queue()
+        self._main_thread = current_thread()
+        self._root.after(self._poll_ms, self._poll)
+
+
+    def submit(self, func, *args, callback=None, **kwargs):
+        '''Ставит функцию в фоновый поток и возвращает Future.
+        callback(result) будет вызван в потоке Tk'''
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(
+            lambda done: self._queue.put(
+                (self._deliver, (done, callback), {}, None)
+            )
+        )
+        return future
+
+
+    def call_in_main(self, func, *args, **kwargs):
+        '''Выполняет функцию в потоке Tk и возвращает ее результат.
+        Фоновый поток ждет, пока главный поток не обработает вызов'''
+        if current_thread() is self._main_thread:
+            return func(*args, **kwargs)
+        future = Future()
+        self._queue.put((func, args, kwargs, future))
+        return future.result()
+
+
+    def shutdown(self, wait=True):
+        '''Останавливает рабочие потоки (при закрытии приложения)'''
+        self._executor.shutdown(wait=wait)
+
+
+    def _deliver(self, future, callback):
+        '''Передает результат фоновой операции обработчику в потоке Tk'''
+        if future.cancelled(): return
+        err = future.exception()
+        # Ошибки, не обработанные внутри самой операции
+        if err is not None:
+            msg = 'Ошибка фоновой операции с БД'
+            self._logger.error(f'{msg}: {repr(err)}')
+            showerror(title=ERROR_MSG, message=f'{msg}. Смотрите лог')
+            return
+        if callback: callback(future.result())
+
+
+    def _poll(self):
+        '''Выполняет накопившиеся в очереди вызовы и планирует
+        следующий опрос'''
+        while True:
+            try:
+                func, args, kwargs, future = self._queue.get_nowait()
+            except Empty:
+                break
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                if future: future.set_exception(err)
+                else: self._logger.error(f'Ошибка в потоке Tk: {repr(err)}')
+            else:
+                if future: future.set_result(result)
+        self._root.after(self._poll_ms, self._poll)